@@ -7,14 +7,8 @@ def main():
     INDIR = Path('datastore/output/derived/fannie_mae')
     OUTDIR = Path('output/analysis/figure_refi_delay')
 
-    df = pd.read_parquet(INDIR / 'sflp_sample_processed_high.parquet')
-    
-    df_agg = (
-        df
-        .groupby('loan_id', as_index=False)
-        .agg({'should_refi': longest_run_of_ones,})
-    )
-    mean_refi_delay = df_agg['should_refi'].mean()
+    df_loans = pd.read_parquet(INDIR / 'sflp_sample_processed_high_loans.parquet', columns=['loan_id', 'should_refi_longest_streak'])
+    mean_refi_delay = df_loans['should_refi_longest_streak'].mean()
     
     GenerateAutofillMacros(
         ["mean_refi_delay"],
@@ -22,10 +16,6 @@ def main():
         OUTDIR / "autofill_mean_refi_delay.tex"
     )
 
-def longest_run_of_ones(x):
-    runs = (x != x.shift()).cumsum()
-    return (x.groupby(runs).cumsum() * x).max()
-
 if __name__ == '__main__':
     main()
 
@@ -15,19 +15,15 @@ def main():
         prob_move = PARAMETERS['PROB_MOVE']
         marginal_tax_rate = PARAMETERS['MARGINAL_TAX_RATE']
         
-        df_full = pd.read_parquet(INDIR / f'sflp_sample_processed_{PARAMETER_TYPE}.parquet')
-        df_full_aggregated = df_full.drop_duplicates(subset=['loan_id'])
-        mean_savings_optimal_refi_full = df_full_aggregated['savings_optimal_refi_adj'].mean()
-        mean_savings_realized_refi_full = df_full_aggregated['savings_realized_refi_adj'].mean()
-        mean_savings_loss_full = df_full_aggregated['savings_loss_adj'].mean()
-        autofill_list.append([PARAMETER_TYPE.lower(), "Full", annual_discount_rate, prob_move, marginal_tax_rate, mean_savings_optimal_refi_full, mean_savings_realized_refi_full, mean_savings_loss_full])
-        
-        df_refi_eligible = pd.read_parquet(INDIR / f'sflp_sample_processed_{PARAMETER_TYPE}_refi_eligible.parquet')
-        df_refi_eligible_aggregated = df_refi_eligible.drop_duplicates(subset=['loan_id'])
-        mean_savings_optimal_refi_refi_eligible = df_refi_eligible_aggregated['savings_optimal_refi_adj'].mean()
-        mean_savings_realized_refi_refi_eligible = df_refi_eligible_aggregated['savings_realized_refi_adj'].mean()
-        mean_savings_loss_refi_eligible = df_refi_eligible_aggregated['savings_loss_adj'].mean()
-        autofill_list.append([PARAMETER_TYPE.lower(), "Refi Eligible", annual_discount_rate, prob_move, marginal_tax_rate, mean_savings_optimal_refi_refi_eligible, mean_savings_realized_refi_refi_eligible, mean_savings_loss_refi_eligible])
+        df_loans = pd.read_parquet(
+            INDIR / f'sflp_sample_processed_{PARAMETER_TYPE.lower()}_loans.parquet',
+            columns=['loan_id', 'refi_eligible', 'savings_optimal_refi_adj', 'savings_realized_refi_adj', 'savings_loss_adj']
+        )
+        for SAMPLE, df_sample in [("Full", df_loans), ("Refi Eligible", df_loans[df_loans['refi_eligible']])]:
+            mean_savings_optimal_refi = df_sample['savings_optimal_refi_adj'].mean()
+            mean_savings_realized_refi = df_sample['savings_realized_refi_adj'].mean()
+            mean_savings_loss = df_sample['savings_loss_adj'].mean()
+            autofill_list.append([PARAMETER_TYPE.lower(), SAMPLE, annual_discount_rate, prob_move, marginal_tax_rate, mean_savings_optimal_refi, mean_savings_realized_refi, mean_savings_loss])
     
     with open(OUTDIR / 'table_savings.txt', 'w') as f:
         f.write("<tab:table_savings>\n")
@@ -8,12 +8,17 @@ from pathlib import Path
 import glob
 import gc
 import time
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+from source.lib.helpers.cluster import get_cluster_config
 from source.lib.helpers.process_text import clean_date, clean_text
 from source.lib.helpers.utils import get_quarters
 from source.lib.save_data import save_data
 
+# sflp_clean is clustered on the columns readers filter on, so that row-group statistics can
+# rule out whole row groups; a loan's rows stay contiguous and sorted by period within a cluster
+SORT_COLUMNS = ['mortgage_type', 'term', 'loan_id', 'period']
+
 def main():
     pd.set_option('future.no_silent_downcasting', True)
     
@@ -29,45 +34,88 @@ def main():
     LOGDIR = Path('output/derived/fannie_mae/sflp_clean')
     START_DATE, END_DATE = CONFIG['SAMPLE_START'], CONFIG['SAMPLE_END']
     QUARTERS = get_quarters(START_DATE, END_DATE)
-    N_CORES = 32
+    N_CORES = get_cluster_config(CONFIG)['N_WORKERS']
     
     cw_state_county = pd.read_csv(INDIR_CW / 'cw_state_county.csv')
     cw_period_date = pd.read_csv(INDIR_CW / 'cw_period_date.csv', parse_dates=['date']).set_index('date')
     
+    worker_quarters = [QUARTERS[i::N_CORES] for i in range(N_CORES) if QUARTERS[i::N_CORES]]
     with ProcessPoolExecutor(max_workers=N_CORES) as executor:
-        executor.map(
-            process_quarter,
-            QUARTERS,
-            [cw_state_county] * len(QUARTERS),
-            [cw_period_date] * len(QUARTERS),
-            [INDIR] * len(QUARTERS),
-            [OUTDIR] * len(QUARTERS),
-            [LOGDIR] * len(QUARTERS)
-        )
+        list(executor.map(
+            process_quarters,
+            worker_quarters,
+            [cw_state_county] * len(worker_quarters),
+            [cw_period_date] * len(worker_quarters),
+            [INDIR] * len(worker_quarters),
+            [OUTDIR] * len(worker_quarters),
+            [LOGDIR] * len(worker_quarters)
+        ))
 
-def process_quarter(quarter, cw_state_county, cw_period_date, INDIR, OUTDIR, LOGDIR):
-    start_time = time.time()
-    parquet_files = glob.glob(str(INDIR / f'{quarter}/*.parquet'))
+def process_quarters(quarters, cw_state_county, cw_period_date, INDIR, OUTDIR, LOGDIR):
+    """Process a worker's quarters in sequence, overlapping disk and CPU.
+    
+    The next quarter is read in a background thread while the current one is
+    transformed, and finished quarters are written in a second background thread.
+    At most one quarter is in flight on each side, so memory stays at roughly
+    three quarters per worker.
+    """
+    with ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(max_workers=1) as writer:
+        next_read = reader.submit(read_quarter, quarters[0], INDIR)
+        pending_write = None
+        for i, quarter in enumerate(quarters):
+            df, n_chunks = next_read.result()
+            if i + 1 < len(quarters):
+                next_read = reader.submit(read_quarter, quarters[i + 1], INDIR)
+            if df is None:
+                print(f"Skipping {quarter}: no input files")
+                continue
+            
+            df_finalized = process_quarter(df, quarter, cw_state_county, cw_period_date)
+            del df
+            
+            if pending_write is not None:
+                pending_write.result()
+            pending_write = writer.submit(write_quarter, df_finalized, quarter, n_chunks, OUTDIR, LOGDIR)
+            del df_finalized
+        
+        if pending_write is not None:
+            pending_write.result()
+
+def read_quarter(quarter, INDIR):
+    parquet_files = sorted(glob.glob(str(INDIR / f'{quarter}/*.parquet')))
     n_chunks = len(parquet_files)
-    dfs = [pd.read_parquet(file) for file in parquet_files]
+    if n_chunks == 0:
+        return None, 0
+    with ThreadPoolExecutor(max_workers=min(n_chunks, 8)) as executor:
+        dfs = list(executor.map(pd.read_parquet, parquet_files))
     df = pd.concat(dfs, ignore_index=True)
+    return df, n_chunks
+
+def process_quarter(df, quarter, cw_state_county, cw_period_date):
+    start_time = time.time()
     print(f"Processing {quarter}: Size {df.shape[0]}")
     
     df_clean = clean_data(df, cw_period_date, quarter=quarter)
     df_with_fips = add_fips(df_clean, cw_state_county)
     df_finalized = finalize_data(df_with_fips)
     
+    elapsed_time = time.time() - start_time
+    print(f"Transformed {quarter} in {elapsed_time:.2f} seconds ({elapsed_time/60:.2f} minutes)")
+    return df_finalized
+
+def write_quarter(df, quarter, n_chunks, OUTDIR, LOGDIR):
+    start_time = time.time()
     save_data(
-        df_finalized,
+        df.sort_values(SORT_COLUMNS, ignore_index=True),
         keys=['loan_id', 'period'],
         out_file=OUTDIR / f'{quarter}.parquet',
         log_file=LOGDIR / f'{quarter}.log',
-        sortbykey=True,
+        sortbykey=False,
         n_partitions=n_chunks
     )
     
     elapsed_time = time.time() - start_time
-    print(f"Completed {quarter} in {elapsed_time:.2f} seconds ({elapsed_time/60:.2f} minutes)")
+    print(f"Wrote {quarter} in {elapsed_time:.2f} seconds ({elapsed_time/60:.2f} minutes)")
 
 def clean_data(df, cw_period_date, keep_vars=None, quarter=None):
     keep_vars = keep_vars or [
@@ -0,0 +1,100 @@
+import json
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+from pathlib import Path
+
+from source.lib.save_data import save_data
+
+# one binning of each gap; every extra bin dimension multiplies the number of cells
+CUBE_BINS = ['rate_gap_adj_bin', 'adl_gap_bin']
+CUBE_KEYS = ['parameter_type', 'refi_eligible', 'vintage', 'period'] + CUBE_BINS + ['state', 'credit_bucket']
+CUBE_INPUT_COLUMNS = ['refi_eligible', 'period_orig', 'period'] + CUBE_BINS + ['state', 'credit_score_orig', 'exit_t1']
+# compact the partial aggregates once they hold this many cells
+COMPACT_ROWS = 1000000
+
+def main():
+    with open('source/lib/config.json', 'r') as f:
+        CONFIG = json.load(f)
+    with open('source/lib/parameters.json', 'r') as f:
+        PARAMETER_LIST = json.load(f)
+    CUBE = CONFIG['PREPAYMENT_CUBE']
+
+    INDIR = Path('datastore/output/derived/fannie_mae')
+    INDIR_CW = Path('datastore/raw/crosswalks/data')
+    OUTDIR = Path('datastore/output/derived/fannie_mae')
+    OUT_FILE = OUTDIR / 'sflp_sample_prepayment_cube.parquet'
+
+    cw_period_date = pd.read_csv(INDIR_CW / 'cw_period_date.csv', parse_dates=['date']).set_index('date')
+    vintage_by_period = pd.Series(cw_period_date.index.year, index=cw_period_date['period'].to_numpy())
+
+    cube_list = []
+    for PARAMETER_TYPE in PARAMETER_LIST:
+        parameter_type = PARAMETER_TYPE.lower()
+        cube = build_prepayment_cube(
+            INDIR / f'sflp_sample_processed_{parameter_type}.parquet',
+            vintage_by_period,
+            credit_score_bins=CUBE['CREDIT_SCORE_BINS'],
+            batch_size=CUBE['BATCH_SIZE']
+        )
+        cube_list.append(cube.assign(parameter_type=parameter_type))
+
+    save_data(
+        pd.concat(cube_list, ignore_index=True)[CUBE_KEYS + ['n_at_risk', 'n_prepaid']],
+        keys = CUBE_KEYS,
+        out_file = OUT_FILE,
+        log_file = OUTDIR / 'sflp_sample_prepayment_cube.log',
+        sortbykey = True
+    )
+
+def build_prepayment_cube(in_file, vintage_by_period, credit_score_bins, batch_size=1000000):
+    """
+    Loans at risk and loans prepaid within the month, by cell of the cube, in one pass over the
+    record batches of a processed loan-month file. Each batch is reduced to its cells as it is
+    read, so memory scales with the cube, not the panel. The processed sample holds only loans
+    that eventually prepay, so prepayment rates read off the cube are biased upward relative to
+    the full population of loans at risk. For the same reason the cube must be rebuilt in full
+    when the sample is extended: a loan that prepays in new periods brings its earlier at-risk
+    months into the sample with it.
+    """
+    dataset = ds.dataset(in_file, format='parquet')
+
+    parts, n_cells = [], 0
+    for batch in dataset.to_batches(columns=CUBE_INPUT_COLUMNS, batch_size=batch_size):
+        part = aggregate_prepayment_counts(batch.to_pandas(), vintage_by_period, credit_score_bins)
+        parts.append(part)
+        n_cells += len(part)
+        if n_cells > COMPACT_ROWS:
+            parts = [combine_prepayment_counts(parts)]
+            n_cells = len(parts[0])
+    return combine_prepayment_counts(parts)
+
+def aggregate_prepayment_counts(df, vintage_by_period, credit_score_bins):
+    """Count loan-months and prepayments by cell. Missing bins, states and credit scores get their own cell (-1 or '')."""
+    cells = pd.DataFrame({
+        'refi_eligible': df['refi_eligible'].astype(int).to_numpy(),
+        'vintage': vintage_by_period.reindex(df['period_orig'].to_numpy()).fillna(-1).astype(int).to_numpy(),
+        'period': df['period'].to_numpy(),
+        'state': df['state'].fillna('').astype(str).to_numpy(),
+        'credit_bucket': compute_credit_bucket(df['credit_score_orig'].to_numpy(dtype=float), credit_score_bins),
+        'n_at_risk': 1,
+        'n_prepaid': df['exit_t1'].to_numpy()
+    })
+    for column in CUBE_BINS:
+        cells[column] = df[column].fillna(-1).astype(int).to_numpy()
+    return combine_prepayment_counts([cells])
+
+def combine_prepayment_counts(parts):
+    """Sum counts over partial aggregates of the same cells."""
+    keys = [key for key in CUBE_KEYS if key != 'parameter_type']
+    columns = keys + ['n_at_risk', 'n_prepaid']
+    if not parts:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(parts, ignore_index=True).groupby(keys, as_index=False, sort=False)[['n_at_risk', 'n_prepaid']].sum()[columns]
+
+def compute_credit_bucket(credit_score, credit_score_bins):
+    """Index of the credit score bucket delimited by `credit_score_bins`, from 0 below the first edge; -1 if missing."""
+    return np.where(np.isnan(credit_score), -1, np.searchsorted(credit_score_bins, credit_score, side='right'))
+
+if __name__ == '__main__':
+    main()
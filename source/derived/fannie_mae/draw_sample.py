@@ -1,44 +1,191 @@
 import json
+import hashlib
+import shutil
+from contextlib import nullcontext
 from pathlib import Path
 import numpy as np
+import pandas as pd
 import dask.dataframe as dd
 from dask import compute, delayed
-from dask.distributed import Client, LocalCluster
 
-from source.lib.save_data import save_data
+from source.lib.helpers.cluster import get_client
+from source.lib.helpers.utils import count_row_groups
+from source.lib.save_data import save_data, save_data_dask
+
+SAMPLE_COLUMNS = [
+    "loan_id", "period", "rate_orig", "upb_orig", "upb_curr",
+    "ltv", "dti", "n_borrowers", "term", "period_orig", "period_first_pay", "time_from_orig", "time_to_maturity",
+    "period_maturity", "time_to_exit", "period_exit", "exit_code", "upb_last", "credit_score_orig",
+    "coborrower_credit_score_orig", "first_home_buyer", "mortgage_type", "purpose", "dlq_status",
+    "state", "state_abbr", "fips_state", "msa", "zip"
+]
+SAMPLE_FILTERS = [('mortgage_type', '==', 'fixed'), ('term', '==', 360)]
+N_SAMPLE_BUCKETS = 1000
 
 def main():
     with open('source/lib/config.json', 'r') as f:
         CONFIG = json.load(f)
-    
+
     INDIR = Path('datastore/output/derived/fannie_mae')
     OUTDIR = Path('datastore/output/derived/fannie_mae')
     SEED = CONFIG['SEED']
     SAMPLE_SIZE = CONFIG['SAMPLE_SIZE']
-    
-    cluster = LocalCluster(n_workers=32, threads_per_worker=1, memory_limit='16 GiB')
-    client = Client(cluster)
+    MAX_SAMPLE_SIZE = CONFIG['MAX_SAMPLE_SIZE']
+    if SAMPLE_SIZE > MAX_SAMPLE_SIZE:
+        raise ValueError(f"SAMPLE_SIZE ({SAMPLE_SIZE}) cannot exceed MAX_SAMPLE_SIZE ({MAX_SAMPLE_SIZE}).")
 
-    ddf = dd.read_parquet(INDIR / 'sflp_clean')
-    
-    sample = build_sample(ddf, random_state=SEED, sample_size=SAMPLE_SIZE).compute()
-    
-    save_data(
-        sample,
-        keys = ['loan_id', 'period'],
-        out_file = OUTDIR / "sflp_sample.parquet",
-        log_file = OUTDIR / "sflp_sample.log",
-        sortbykey = True
-    )
-
-def build_sample(ddf, random_state=123, sample_size=0.005):
+    manifest = {
+        'SEED': SEED,
+        'MAX_SAMPLE_SIZE': MAX_SAMPLE_SIZE,
+        'sflp_clean': fingerprint_dataset(INDIR / 'sflp_clean')
+    }
+    index_is_current = sample_index_is_current(OUTDIR / 'sflp_sample_index.json', manifest)
+    if not index_is_current:
+        n_row_groups, n_row_groups_read = count_row_groups(INDIR / 'sflp_clean', SAMPLE_FILTERS)
+        print(f"Reading {n_row_groups_read} of {n_row_groups} row groups of sflp_clean")
+
+    # one cluster serves both the index and the sample, and none is started if neither needs it
+    use_cluster = not index_is_current or CONFIG['SAMPLE_WRITE_FROM_WORKERS']
+    with get_client(CONFIG) if use_cluster else nullcontext():
+        if not index_is_current:
+            ddf = dd.read_parquet(
+                INDIR / 'sflp_clean',
+                columns=SAMPLE_COLUMNS,
+                filters=SAMPLE_FILTERS
+            )
+            ddf = filter_sample_universe(ddf)
+
+            save_data_dask(
+                build_sample_index(ddf, random_state=SEED),
+                keys = ['loan_id'],
+                out_file = OUTDIR / "sflp_sample_index.parquet",
+                log_file = OUTDIR / "sflp_sample_index.log",
+                sortbykey = False
+            )
+            build_sample_pool(ddf, max_sample_size=MAX_SAMPLE_SIZE, random_state=SEED).to_parquet(
+                OUTDIR / 'sflp_sample_pool',
+                engine = "pyarrow",
+                compression = "snappy",
+                partition_on = ['sample_bucket'],
+                write_index = False,
+                overwrite = True
+            )
+            with open(OUTDIR / 'sflp_sample_index.json', 'w') as f:
+                json.dump(manifest, f, indent=4)
+
+        # the workers write a directory of parts and save_data a single file, so either may be on disk
+        remove_output(OUTDIR / 'sflp_sample.parquet')
+        if CONFIG['SAMPLE_WRITE_FROM_WORKERS']:
+            sample = load_sample(OUTDIR / 'sflp_sample_index.parquet', OUTDIR / 'sflp_sample_pool', sample_size=SAMPLE_SIZE, lazy=True)
+            save_data_dask(
+                sample,
+                keys = ['loan_id', 'period'],
+                out_file = OUTDIR / "sflp_sample.parquet",
+                log_file = OUTDIR / "sflp_sample.log",
+                sortbykey = True
+            )
+        else:
+            sample = load_sample(OUTDIR / 'sflp_sample_index.parquet', OUTDIR / 'sflp_sample_pool', sample_size=SAMPLE_SIZE)
+            save_data(
+                sample,
+                keys = ['loan_id', 'period'],
+                out_file = OUTDIR / "sflp_sample.parquet",
+                log_file = OUTDIR / "sflp_sample.log",
+                sortbykey = True
+            )
+
+def filter_sample_universe(ddf):
+    """Restrict to fixed-rate 30-year loans.
+
+    The mask repeats `SAMPLE_FILTERS`, which `main` pushes into the read so row
+    groups excluded by their statistics are skipped.
+    """
     mask = ((ddf['mortgage_type'] == 'fixed') & (ddf['term'] == 360))
-    ddf_filtered = ddf[mask]
-    ids = ddf_filtered[['loan_id', 'period_orig']].drop_duplicates().compute()
-    sample_ids = ids.groupby('period_orig').sample(frac=sample_size, random_state=random_state)['loan_id'].tolist()
-    ddf_sample = ddf_filtered[ddf_filtered['loan_id'].isin(sample_ids)]
-    return ddf_sample
+    return ddf[mask]
+
+def build_sample_index(ddf, random_state=123):
+    """Build the persistent sample index: one row per loan with its draw, partition by partition.
+
+    `sample_draw` is a seeded hash of `loan_id` mapped to [0, 1), so keeping loans with
+    `sample_draw <= r` takes each loan with probability r, a share r of every `period_orig`
+    stratum in expectation, and the sample at a smaller rate is always nested inside the
+    sample at a larger one. Only the last loan id of each partition is collected: `ddf` must
+    keep a loan's rows contiguous, and a loan straddling two partitions is kept in the first.
+    """
+    ids = ddf[['loan_id', 'period_orig']].map_partitions(lambda df: df.drop_duplicates(subset=['loan_id']))
+    last_ids = ids['loan_id'].map_partitions(get_last_value, meta=('loan_id', 'object')).compute().ffill().shift()
+    ids = ids.map_partitions(drop_straddling_loan, last_ids.tolist(), meta=ids._meta)
+    return ids.assign(sample_draw=ids['loan_id'].map_partitions(compute_sample_draw, random_state, meta=('sample_draw', 'f8')))
+
+def get_last_value(s):
+    return pd.Series([s.iloc[-1] if len(s) else None], dtype=object)
+
+def drop_straddling_loan(df, previous_last_ids, partition_info=None):
+    """Drop the first loan of a partition if it continues the last loan of an earlier partition."""
+    previous_last_id = previous_last_ids[partition_info['number']]
+    if len(df) and df['loan_id'].iloc[0] == previous_last_id:
+        return df.iloc[1:]
+    return df
+
+def build_sample_pool(ddf, max_sample_size=0.05, random_state=123):
+    """
+    Every loan-month of the loans drawn below `max_sample_size`, tagged with the bucket of their draw
+    for partitioning. Which loans make up a sample is read from the index, not the pool.
+    """
+    pool = ddf.assign(sample_draw=ddf['loan_id'].map_partitions(compute_sample_draw, random_state, meta=('sample_draw', 'f8')))
+    pool = pool[pool['sample_draw'] <= max_sample_size]
+    pool = pool.assign(sample_bucket=pool['sample_draw'].map_partitions(compute_sample_bucket, meta=('sample_bucket', 'i8')))
+    return pool.drop(columns='sample_draw')
+
+def load_sample(index_file, pool_dir, sample_size=0.005, columns=None, lazy=False):
+    """Read the nested sample at `sample_size`: the loans the index draws at that rate, read
+    from only the buckets of the pool that can hold them. `columns` must include `loan_id`.
+    
+    With `lazy=True` the sample is returned as a dask DataFrame so that workers can
+    write it out without collecting it on the driver.
+    """
+    sample_ids = pd.read_parquet(index_file, columns=['loan_id'], filters=[('sample_draw', '<=', sample_size)])['loan_id']
+    max_bucket = int(compute_sample_bucket(pd.Series([sample_size])).iloc[0])
+    read_parquet = dd.read_parquet if lazy else pd.read_parquet
+    sample = read_parquet(pool_dir, columns=columns, filters=[('sample_bucket', '<=', max_bucket)])
+    # filtered partition by partition: dask's own isin stalls the sort in save_data_dask
+    sample = sample.map_partitions(select_loans, sample_ids.to_numpy()) if lazy else select_loans(sample, sample_ids.to_numpy())
+    return sample.drop(columns=['sample_bucket'], errors='ignore')
+
+def select_loans(df, loan_ids):
+    return df[df['loan_id'].isin(loan_ids)]
+
+def compute_sample_draw(loan_id, random_state=123):
+    """Map each loan id to a stable uniform draw on [0, 1)."""
+    hash_key = f'{random_state:016d}'[-16:]
+    hashed = pd.util.hash_pandas_object(loan_id.astype(str), index=False, hash_key=hash_key)
+    return pd.Series(hashed.to_numpy() / 2**64, index=loan_id.index)
+
+def compute_sample_bucket(sample_draw):
+    return np.ceil(sample_draw * N_SAMPLE_BUCKETS).astype(int)
+
+def remove_output(path):
+    """Delete a file or a directory dataset if it exists."""
+    path = Path(path)
+    if path.is_dir():
+        shutil.rmtree(path)
+    elif path.exists():
+        path.unlink()
+
+def fingerprint_dataset(path):
+    """Hash the names, sizes and modification times of the files in a dataset."""
+    files = sorted(Path(path).rglob('*.parquet'))
+    fingerprint = hashlib.md5()
+    for file in files:
+        stat = file.stat()
+        fingerprint.update(f'{file.relative_to(path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return fingerprint.hexdigest()
+
+def sample_index_is_current(manifest_file, manifest):
+    if not Path(manifest_file).exists():
+        return False
+    with open(manifest_file, 'r') as f:
+        return json.load(f) == manifest
 
 if __name__ == "__main__":
     main()
-
@@ -4,72 +4,238 @@ import pandas as pd
 import janitor
 import json
 import glob
+import argparse
+import itertools
 import pyarrow
 from pathlib import Path
-from sklearn.linear_model import LinearRegression
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import dask
+import dask.dataframe as dd
 
+from source.lib.helpers.checkpoint import hash_frame, run_parameter_stage, run_stage
+from source.lib.helpers.column_dag import derives, plan_stages
+from source.lib.helpers.cluster import get_client, get_cluster_config
+from source.lib.helpers import column_dag, market_data, mortgage, optimal_refi, regression, utils
+from source.lib.helpers.optimal_refi import interpolate_refi_threshold, solve_refi_thresholds
+from source.lib.helpers.profiling import StageProfiler
+from source.lib.helpers.market_data import PeriodSeries, compute_mortgage_rate_vol, get_period, load_market_data
+from source.lib.helpers.regression import accumulate_normal_equations, build_design_matrix, combine_normal_equations, solve_normal_equations
+from source.lib.helpers.utils import get_block_index, get_block_position, get_block_starts, get_block_cummax, get_first_in_block, get_run_length
 from source.lib.save_data import save_data
 
+INPUT_COLUMNS = [
+    "loan_id", "period", "rate_orig", "upb_orig", "upb_curr", 
+    "ltv", "dti", "n_borrowers", "term", "period_orig", "period_first_pay", "time_from_orig", "time_to_maturity", 
+    "period_maturity", "time_to_exit", "period_exit", "exit_code", "upb_last", "credit_score_orig", 
+    "coborrower_credit_score_orig", "first_home_buyer", "mortgage_type", "purpose", "dlq_status", 
+    "state", "state_abbr", "fips_state", "msa", "zip"
+]
+LOAN_COLUMNS = [
+    "loan_id", "period_orig", "rate_orig", "upb_orig", "term", "ltv", "dti", "n_borrowers", "credit_score_orig",
+    "coborrower_credit_score_orig", "first_home_buyer", "purpose", "state", "msa", "zip",
+    "period_exit", "exit_code", "upb_last", "annual_payment_orig",
+    "npv_never_refi", "npv_optimal_refi", "npv_realized_refi",
+    "savings_optimal_refi", "savings_realized_refi", "savings_loss",
+    "savings_optimal_refi_adj", "savings_realized_refi_adj", "savings_loss_adj"
+]
+# columns build_loan_table reads, which are computed whatever PROCESS_COLUMNS requests
+LOAN_TABLE_INPUTS = LOAN_COLUMNS + ["period", "should_refi_adj", "should_refi_longest_streak", "exit_in_the_money"]
+# loan-month columns read by build_prepayment_cube.py, simulate_refi_savings.py and the figures in
+# source/analysis, which are computed and saved whatever PROCESS_COLUMNS requests
+LOAN_MONTH_READER_COLUMNS = [
+    "loan_id", "period", "period_orig", "period_exit", "refi_eligible", "state", "credit_score_orig", "purpose",
+    "rate_orig", "upb_orig", "term", "time_from_orig", "time_to_maturity", "annual_payment_orig",
+    "rate_mortgage30us_orig", "rate_mortgage30us_adj", "rate_gap_adj", "rate_gap_adj_bin", "adl_gap_bin",
+    "adl_gap_adj_bin", "exit_t1"
+]
+STREAM_FILTERS = [('mortgage_type', '==', 'fixed'), ('term', '==', 360)]
+PROFILE_STAGES = [
+    "add_event_indicators", "add_fred", "impute_current_upb", "compute_rate_spread", "compute_rate_gap",
+    "compute_annual_payment", "compute_sample_masks", "compute_parameter_columns", "compute_adl_threshold",
+    "compute_should_refi", "compute_dp_threshold", "compute_refi_timing", "compute_savings",
+    "compute_inflation_adjustments", "build_loan_table", "save_data"
+]
+
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sweep', action='store_true', help="Summarize savings over the grid in sweep.json instead of saving loan-month files")
+    parser.add_argument('--stream', action='store_true', help="Process all of sflp_clean one loan partition at a time and save loan-level results")
+    parser.add_argument('--profile', action='store_true', help="Record wall time, peak memory and row counts of each stage and write a ranked report")
+    parser.add_argument('--cprofile', action='store_true', help="With --profile, also include a cProfile of each outermost stage in the report")
+    args = parser.parse_args()
+    if args.profile and (args.sweep or args.stream):
+        parser.error('--profile applies to the default in-memory run only')
+    
+    with open('source/lib/config.json', 'r') as f:
+        CONFIG = json.load(f)
     with open('source/lib/parameters.json', 'r') as f:
         PARAMETER_LIST = json.load(f)
+    PARAMETER_GRID = pd.DataFrame.from_dict(PARAMETER_LIST, orient='index')
     
     INDIR_SFLP = Path('datastore/output/derived/fannie_mae')
     INDIR_FRED = Path('output/derived/fred')
     INDIR_CW = Path('datastore/raw/crosswalks/data')
     OUTDIR = Path('datastore/output/derived/fannie_mae')
+    CACHEDIR = OUTDIR / 'process_cache' if CONFIG['STAGE_CACHE'] else None
+    
+    if args.profile:
+        profiler = StageProfiler(cprofile=args.cprofile)
+        profiler.instrument(globals(), PROFILE_STAGES)
+        # cached stages would not run, so the cache is bypassed while profiling
+        CACHEDIR = None
+    
+    mortgage30us = pd.read_csv(INDIR_FRED / 'mortgage30us.csv', parse_dates=['date'])
+    cpi = pd.read_csv(INDIR_FRED / 'cpiaucsl.csv', parse_dates=['date'])
+    cw_period_date = pd.read_csv(INDIR_CW / 'cw_period_date.csv', parse_dates=['date']).set_index('date')
+    
+    if args.stream:
+        with get_client(CONFIG):
+            ddf = dd.read_parquet(INDIR_SFLP / 'sflp_clean', columns=INPUT_COLUMNS, filters=STREAM_FILTERS)
+            df_summary = run_stream(
+                ddf, mortgage30us, cpi, cw_period_date, PARAMETER_GRID,
+                out_dir=OUTDIR / 'sflp_clean_processed_loans',
+                rate_spread_spec=CONFIG['RATE_SPREAD']
+            )
+        save_data(
+            df_summary,
+            keys = ['parameter_type', 'sample'],
+            out_file = OUTDIR / 'sflp_clean_processed_summary.parquet',
+            log_file = OUTDIR / 'sflp_clean_processed_summary.log',
+            sortbykey = True
+        )
+        return
 
     df = pd.read_parquet(INDIR_SFLP / 'sflp_sample.parquet')
     
     #### BEGIN TEMPORARY: REMOVE REDUANDANT COLUMNS
-    df = df.select(columns=[
-        "loan_id", "period", "rate_orig", "upb_orig", "upb_curr", 
-        "ltv", "dti", "n_borrowers", "term", "period_orig", "period_first_pay", "time_from_orig", "time_to_maturity", 
-        "period_maturity", "time_to_exit", "period_exit", "exit_code", "upb_last", "credit_score_orig", 
-        "coborrower_credit_score_orig", "first_home_buyer", "mortgage_type", "purpose", "dlq_status", 
-        "state", "state_abbr", "fips_state", "msa", "zip"
-    ])
+    df = df.select(columns=INPUT_COLUMNS)
     #### END TEMPORARY
+    # the block helpers assume each loan's rows are contiguous and sorted by period
+    df = df.sort_values(['loan_id', 'period'], ignore_index=True)
     
-    mortgage30us = pd.read_csv(INDIR_FRED / 'mortgage30us.csv', parse_dates=['date'])
-    cpi = pd.read_csv(INDIR_FRED / 'cpiaucsl.csv', parse_dates=['date'])
-    cw_period_date = pd.read_csv(INDIR_CW / 'cw_period_date.csv', parse_dates=['date']).set_index('date')
+    # stages declare the columns they read and add; only those behind the requested columns run
+    output_columns = None if args.sweep else CONFIG['PROCESS_COLUMNS']
+    row_stages = {
+        add_event_indicators: ((), []),
+        add_fred: ((mortgage30us, cpi, cw_period_date), [market_data]),
+        impute_current_upb: ((), [compute_current_upb, mortgage, utils]),
+        compute_rate_spread: (
+            (CONFIG['RATE_SPREAD'],),
+            [get_fixed_effect_levels, build_rate_spread_design, compute_rate_spread_moments, fit_rate_spread, regression]
+        ),
+        compute_rate_gap: ((), []),
+        compute_annual_payment: ((), [compute_annuity, mortgage, utils])
+    }
+    if output_columns is not None:
+        known_columns = set(INPUT_COLUMNS) | {'refi_eligible'} | {column for stage in list(row_stages) + get_parameter_steps() for column in stage.outputs}
+        unknown_columns = sorted(set(output_columns) - known_columns)
+        if unknown_columns:
+            raise ValueError(f"PROCESS_COLUMNS lists columns no stage produces: {', '.join(unknown_columns)}")
+    targets = None if output_columns is None else sorted(set(output_columns) | set(LOAN_TABLE_INPUTS) | set(LOAN_MONTH_READER_COLUMNS))
+    plan = plan_stages(list(row_stages) + get_parameter_steps(), targets)[0]
     
-    df = add_event_indicators(df)
-    df = add_fred(df, mortgage30us, cpi, cw_period_date)
-    df = impute_current_upb(df)
-    df = compute_rate_spread(df)
-    df = compute_rate_gap(df)
+    # each stage is cached under its input, its code, the source of the helper modules it calls and the parameters it reads
+    key = hash_frame(df) if CACHEDIR else None
+    for stage in row_stages:
+        if stage in plan:
+            stage_args, depends_on = row_stages[stage]
+            df, key = run_stage(stage, df, *stage_args, input_key=key, cache_dir=CACHEDIR, depends_on=depends_on)
     
-    for PARAMETER_TYPE, PARAMETERS in PARAMETER_LIST.items():
-        df_adl = compute_adl_threshold(df, mortgage30us, parameters=PARAMETERS)
-        df_adl = compute_adl_gap(df_adl)
-        df_adl = compute_should_refi(df_adl)
-        df_adl = df_adl.groupby('loan_id', as_index=False).apply(compute_savings)
-        df_adl = compute_inflation_adjustments(df_adl, cpi, cw_period_date)
-        
-        mask_full_sample = (df_adl["exit_code"] == "prepaid") & (df_adl['mortgage_type'] == 'fixed') & (df_adl["time_to_exit"] >= 1) & (df_adl["time_from_orig"] >= 0) 
-        mask_refi_eligible = mask_full_sample & (df_adl["credit_score_orig"] > 680) & (df_adl["ltv"] < 90) & (df_adl["dlq_status"] == 0)
-
-        df_adl_full = df_adl[mask_full_sample]
-        df_adl_refi_eligible = df_adl[mask_refi_eligible]
+    mask_full_sample, mask_refi_eligible = compute_sample_masks(df)
+    
+    if args.sweep:
+        with open('source/lib/sweep.json', 'r') as f:
+            SWEEP = json.load(f)
+        df_sweep = run_sweep(
+            df, mortgage30us, cpi, cw_period_date,
+            sweep_grid=build_sweep_grid(SWEEP['GRID']),
+            mask_full_sample=mask_full_sample,
+            mask_refi_eligible=mask_refi_eligible,
+            chunk_size=SWEEP['CHUNK_SIZE'],
+            n_workers=get_cluster_config(CONFIG)['N_WORKERS']
+        )
+        save_data(
+            df_sweep,
+            keys = ['annual_discount_rate', 'prob_move', 'marginal_tax_rate', 'sample'],
+            out_file = OUTDIR / 'sflp_sample_sweep.parquet',
+            log_file = OUTDIR / 'sflp_sample_sweep.log',
+            sortbykey = True
+        )
+        return
+    
+    # the refinance-eligible sample is a subset of the full sample, so it is stored as a flag
+    df_full = df[mask_full_sample].assign(refi_eligible=mask_refi_eligible[mask_full_sample])
+    
+    parameter_columns = run_parameter_stage(
+        compute_parameter_columns, df, mortgage30us, cpi, cw_period_date, targets,
+        parameter_grid=PARAMETER_GRID,
+        input_key=key,
+        cache_dir=CACHEDIR,
+        depends_on=[
+            compute_adl_threshold, compute_adl_gap, compute_bins, compute_should_refi, compute_dp_threshold,
+            compute_refi_timing, compute_savings, compute_loan_savings, compute_npv_never_refi, compute_npv_optimal_refi,
+            compute_npv_realized_refi, compute_npv_refi, compute_annuity, expand_loan_values,
+            compute_inflation_adjustments, compute_inflation_factor, get_parameter_steps,
+            column_dag, market_data, mortgage, optimal_refi, utils
+        ]
+    )
+    
+    for i, PARAMETER_TYPE in enumerate(PARAMETER_GRID.index):
+        df_adl_full = df_full.assign(**{column: values[mask_full_sample, i] for column, values in parameter_columns.items()})
+        save_columns = df_adl_full.columns if output_columns is None else [
+            column for column in df_adl_full.columns if column in set(output_columns) | set(LOAN_MONTH_READER_COLUMNS)
+        ]
         
         save_data(
-            df_adl_full,
+            df_adl_full[save_columns],
             keys = ['loan_id', 'period'],
             out_file = OUTDIR / f'sflp_sample_processed_{PARAMETER_TYPE.lower()}.parquet',
             log_file = OUTDIR / f'sflp_sample_processed_{PARAMETER_TYPE.lower()}.log',
             sortbykey = True
         )
-
+        
         save_data(
-            df_adl_refi_eligible,
-            keys = ['loan_id', 'period'],
-            out_file = OUTDIR / f'sflp_sample_processed_{PARAMETER_TYPE.lower()}_refi_eligible.parquet',
-            log_file = OUTDIR / f'sflp_sample_processed_{PARAMETER_TYPE.lower()}_refi_eligible.log',
+            build_loan_table(df_adl_full),
+            keys = ['loan_id'],
+            out_file = OUTDIR / f'sflp_sample_processed_{PARAMETER_TYPE.lower()}_loans.parquet',
+            log_file = OUTDIR / f'sflp_sample_processed_{PARAMETER_TYPE.lower()}_loans.log',
             sortbykey = True
         )
+    
+    if args.profile:
+        profiler.write_report(OUTDIR / 'sflp_sample_processed_profile.log')
+
+def build_loan_table(df):
+    """
+    One row per loan of a processed loan-month frame: static attributes, exit, NPVs, savings and
+    refinance timing. Rows of a loan must be contiguous and sorted by period.
+    """
+    loan_ids = df['loan_id']
+    starts = get_block_starts(loan_ids)
+    ends = np.append(np.flatnonzero(starts)[1:], len(starts)) - 1
+    block = get_block_index(loan_ids)
+    loans = df.loc[starts, LOAN_COLUMNS].reset_index(drop=True)
+    
+    should_refi_row = get_first_in_block(df['should_refi_adj'].to_numpy() == 1, loan_ids)
+    loans['refi_eligible'] = get_first_in_block(df['refi_eligible'].to_numpy(), loan_ids) >= 0
+    loans['n_months'] = np.bincount(block)
+    loans['period_should_refi_first'] = np.where(should_refi_row >= 0, df['period'].to_numpy()[np.maximum(should_refi_row, 0)], np.nan)
+    loans['months_should_refi'] = np.bincount(block, weights=df['should_refi_adj'].to_numpy()).astype(int)
+    loans['should_refi_longest_streak'] = df['should_refi_longest_streak'].to_numpy()[ends]
+    loans['exit_in_the_money'] = df['exit_in_the_money'].to_numpy()[ends]
+    return loans
+
+def compute_sample_masks(df):
+    """Loan-month masks for the full sample and the refinance-eligible subsample."""
+    mask_full_sample = ((df["exit_code"] == "prepaid") & (df['mortgage_type'] == 'fixed') & (df["time_to_exit"] >= 1) & (df["time_from_orig"] >= 0)).to_numpy()
+    mask_refi_eligible = mask_full_sample & ((df["credit_score_orig"] > 680) & (df["ltv"] < 90) & (df["dlq_status"] == 0)).to_numpy()
+    return mask_full_sample, mask_refi_eligible
 
+@derives(
+    inputs=['time_to_exit'],
+    outputs=['exit_t1', 'exit_t3', 'exit_t6', 'exit_t12', 'exit_t24']
+)
 def add_event_indicators(df):
     df = df.copy()
     df['exit_t1'] = np.where(df['time_to_exit'] == 1, 1, 0)
@@ -79,59 +245,82 @@ def add_event_indicators(df):
     df['exit_t24'] = np.where(df['time_to_exit'] <= 24, 1, 0)
     return df
 
+@derives(
+    inputs=['period', 'period_orig'],
+    outputs=['rate_mortgage30us', 'rate_mortgage30us_orig', 'cpi', 'inflation_annualized']
+)
 def add_fred(df, mortgage30us, cpi, cw_period_date):
-    mortgage30us_period = (
-        mortgage30us
-        .merge(cw_period_date, left_on='date', right_index=True, how='left')
-        .drop(columns=['date'])
-    )
-    df_with_mortgage_rates = (
-        df
-        .merge(mortgage30us_period.rename(columns={'mortgage_rate': 'rate_mortgage30us'}), on='period', how='left')
-        .merge(mortgage30us_period.rename(columns={'mortgage_rate': 'rate_mortgage30us_orig', 'period': 'period_orig'}), on='period_orig', how='left')
-    )
-    
-    cpi_period = (
-        cpi
-        .merge(cw_period_date, left_on='date', right_index=True, how='left')
-        .drop(columns=['date'])
-    )
-    df_with_cpi = (
-        df_with_mortgage_rates
-        .merge(cpi_period, on='period', how='left')
-        .assign(inflation_annualized = lambda x: np.log(x["cpi"] / x["cpi"].shift(12)))
-    )
-    return df_with_cpi
+    """Add mortgage rates at the current and origination periods and CPI inflation, by indexing period arrays."""
+    market_data = load_market_data(mortgage30us, cpi, cw_period_date)
+    period = df['period'].to_numpy()
+    df['rate_mortgage30us'] = market_data['mortgage_rate'][period]
+    df['rate_mortgage30us_orig'] = market_data['mortgage_rate'][df['period_orig'].to_numpy()]
+    df['cpi'] = market_data['cpi'][period]
+    df['inflation_annualized'] = np.log(df['cpi'].to_numpy() / market_data['cpi'][period - 12])
+    return df
 
+@derives(
+    inputs=['loan_id', 'time_from_orig', 'rate_orig', 'term', 'upb_orig', 'upb_curr'],
+    outputs=['upb_curr_imputed', 'upb_curr']
+)
 def impute_current_upb(df):
-    """Calculate current UPB at a given loan age"""
-    df['upb_curr_imputed'] = df.apply(
-        lambda row: compute_current_upb(
-            loan_age=row['time_from_orig'],
-            monthly_interest_rate=((row['rate_orig'] / 100) / 12),
-            term=row['term'],
-            principal=row['upb_orig']
-        ),
-        axis=1
+    """Calculate current UPB at a given loan age. Rows of a loan must be contiguous."""
+    df['upb_curr_imputed'] = compute_current_upb(
+        loan_age=df['time_from_orig'].to_numpy(),
+        monthly_interest_rate=((df['rate_orig'].to_numpy() / 100) / 12),
+        term=df['term'].to_numpy(),
+        principal=df['upb_orig'].to_numpy()
     )
     
-    mask = (df['upb_curr'] == 0) & (df.groupby('loan_id').cumcount() < 6)
+    mask = (df['upb_curr'].to_numpy() == 0) & (get_block_position(df['loan_id']) < 6)
     df.loc[mask, 'upb_curr'] = df.loc[mask, 'upb_curr_imputed']
     df = df.reset_index(drop=True)
     return df
 
-def compute_rate_spread(df):
+@derives(
+    inputs=['loan_id', 'rate_orig', 'rate_mortgage30us', 'rate_mortgage30us_orig'],
+    outputs=['rate_spread_orig', 'rate_spread_pred', 'rate_mortgage30us_adj']
+)
+def compute_rate_spread(df, spec=None, model=None):
+    """
+    Predict the spread of a new loan's rate over MORTGAGE30US from the market rate and the loan
+    covariates and fixed effects listed in `spec` (the RATE_SPREAD block of config.json), e.g.
+    COVARIATES ['ltv', 'credit_score_orig', 'n_borrowers', 'dti'] and FIXED_EFFECTS ['state', 'period_orig'].
+    The model is fit on one row per loan unless a `model` from `fit_rate_spread` is passed in.
+    """
+    spec = spec or {'COVARIATES': [], 'FIXED_EFFECTS': []}
     df['rate_spread_orig'] = df['rate_orig'] - df['rate_mortgage30us_orig']
-    data_train = df.drop_duplicates(subset=['loan_id'])
-    X_train = data_train[['rate_mortgage30us_orig']].rename(columns={'rate_mortgage30us_orig': 'rate'})
-    # X_train = data_train[['rate_mortgage30us', 'ltv', 'credit_score_orig', 'n_borrowers', 'dti']]
-    y_train = data_train['rate_spread_orig']
-    model = LinearRegression().fit(X_train, y_train)
+    if model is None:
+        data_train = df.drop_duplicates(subset=['loan_id'])
+        levels = get_fixed_effect_levels(data_train, spec)
+        model = fit_rate_spread([compute_rate_spread_moments(data_train, spec, levels)], levels)
     
-    df['rate_spread_pred'] = model.predict(df[['rate_mortgage30us']].rename(columns={'rate_mortgage30us': 'rate'}))
+    X = build_rate_spread_design(df, spec, model['levels'], rate_column='rate_mortgage30us')
+    df['rate_spread_pred'] = X @ model['coefficients']
     df['rate_mortgage30us_adj'] = df['rate_mortgage30us'] + df['rate_spread_pred']
     return df
 
+def get_fixed_effect_levels(df, spec):
+    return {column: sorted(df[column].dropna().unique()) for column in spec['FIXED_EFFECTS']}
+
+def build_rate_spread_design(df, spec, levels, rate_column):
+    """Regressors of the spread model: the market rate in `rate_column`, then the loan covariates and fixed effects."""
+    return build_design_matrix(df, [rate_column] + spec['COVARIATES'], fixed_effects=levels)
+
+def compute_rate_spread_moments(data_train, spec, levels):
+    """Normal equations of the spread model from one row per loan, at the origination market rate. They add across partitions."""
+    X = build_rate_spread_design(data_train, spec, levels, rate_column='rate_mortgage30us_orig')
+    y = (data_train['rate_orig'] - data_train['rate_mortgage30us_orig']).to_numpy(dtype=float)
+    return accumulate_normal_equations(X, y)
+
+def fit_rate_spread(moments, levels):
+    """Spread model from the normal equations of every partition."""
+    return {'coefficients': solve_normal_equations(combine_normal_equations(moments)), 'levels': levels}
+
+@derives(
+    inputs=['rate_orig', 'rate_mortgage30us', 'rate_mortgage30us_adj'],
+    outputs=['rate_gap', 'rate_gap_adj', 'rate_gap_bin', 'rate_gap_adj_bin']
+)
 def compute_rate_gap(df, bin_size=0.2, min_bin = -4.0, max_bin = 4.0):
     df['rate_gap'] = df['rate_orig'] - df['rate_mortgage30us']
     df['rate_gap_adj'] = df['rate_orig'] - df['rate_mortgage30us_adj']
@@ -143,140 +332,449 @@ def compute_rate_gap(df, bin_size=0.2, min_bin = -4.0, max_bin = 4.0):
     return df
 
 def compute_current_upb(loan_age=None, monthly_interest_rate=None, term=None, principal=None):
-    return principal * ((1 + monthly_interest_rate)**term - (1 + monthly_interest_rate)**loan_age) / ((1 + monthly_interest_rate)**term - 1)
-
-def compute_adl_threshold(df, mortgage30us, parameters={'ANNUAL_DISCOUNT_RATE': 0.05, 'PROB_MOVE': 0.1, 'MARGINAL_TAX_RATE': 0.28}):
-    """Compute the Agarwal, Driscoll, Laibson (2013) optimal refinance thresholds. This is the 'square root rule'."""
-    _annual_payment = df.apply(
-        lambda row: compute_annuity(
-            interest_rate=(row['rate_orig'] / 100),
-            term=row['term'] / 12,
-            principal=row['upb_orig']
-        ),
-        axis=1
-    )
+    return mortgage.current_upb(loan_age, monthly_interest_rate, term, principal)
+
+def compute_parameter_columns(df, mortgage30us, cpi, cw_period_date, targets, parameter_grid):
+    """
+    Evaluate the parameter-dependent columns for every parameter set at once, running only the
+    steps needed for the `targets` columns (all steps if None). Each returned array has one row
+    per row of `df` and one column per row of `parameter_grid`.
+    """
+    columns = {}
+    steps = {
+        'compute_adl_threshold': lambda: {'adl_threshold': compute_adl_threshold(df, mortgage30us, parameter_grid)},
+        'compute_adl_gap': lambda: compute_adl_gap(df, columns['adl_threshold']),
+        'compute_should_refi': lambda: compute_should_refi(df, columns['adl_threshold']),
+        'compute_dp_threshold': lambda: compute_dp_threshold(df, mortgage30us, parameter_grid),
+        'compute_refi_timing': lambda: compute_refi_timing(df, columns['should_refi']),
+        'compute_savings': lambda: compute_savings(df, columns['should_refi_adj']),
+        'compute_inflation_adjustments': lambda: compute_inflation_adjustments(df, columns, cpi, cw_period_date)
+    }
+    for step in plan_stages(get_parameter_steps(), targets)[0]:
+        columns.update(steps[step.__name__]())
+    return columns
+
+def get_parameter_steps():
+    """Parameter-dependent steps of `compute_parameter_columns`, in dependency order."""
+    return [
+        compute_adl_threshold, compute_adl_gap, compute_should_refi, compute_dp_threshold,
+        compute_refi_timing, compute_savings, compute_inflation_adjustments
+    ]
+
+@derives(
+    inputs=['upb_curr', 'annual_payment_orig', 'rate_orig'],
+    outputs=['adl_threshold']
+)
+def compute_adl_threshold(df, mortgage30us, parameter_grid):
+    """
+    Compute the Agarwal, Driscoll, Laibson (2013) optimal refinance thresholds. This is the 'square root rule'.
+    Returns one column per parameter set in `parameter_grid`.
+    """
+    if 'annual_payment_orig' not in df.columns:
+        df = compute_annual_payment(df)
+    _annual_payment = df['annual_payment_orig'].to_numpy()[:, None]
+    _upb_curr = df["upb_curr"].to_numpy()[:, None]
+    _rate_orig = df["rate_orig"].to_numpy()[:, None]
+    _annual_discount_rate = parameter_grid['ANNUAL_DISCOUNT_RATE'].to_numpy()[None, :]
+    _prob_move = parameter_grid['PROB_MOVE'].to_numpy()[None, :]
+    _marginal_tax_rate = parameter_grid['MARGINAL_TAX_RATE'].to_numpy()[None, :]
+    
     _monthly_mortgage_rate_vol = compute_mortgage_rate_vol(mortgage30us)
-    _transaction_cost = 0.01 * df["upb_curr"] + 2000
-    _lambda = parameters['PROB_MOVE'] + ((_annual_payment / df["upb_curr"]) - (df["rate_orig"] / 100)) + 0.03
-    df['adl_threshold'] = 100 * np.sqrt((_monthly_mortgage_rate_vol * _transaction_cost) / (df["upb_curr"] * (1 - parameters['MARGINAL_TAX_RATE']))) * np.sqrt(2 * (parameters['ANNUAL_DISCOUNT_RATE'] + _lambda))
+    adl_threshold = mortgage.adl_threshold(_upb_curr, _annual_payment, _rate_orig, _monthly_mortgage_rate_vol, _annual_discount_rate, _prob_move, _marginal_tax_rate)
+    return adl_threshold
+
+@derives(
+    inputs=['upb_curr', 'time_to_maturity', 'rate_orig', 'rate_gap_adj'],
+    outputs=['dp_threshold', 'dp_gap_adj', 'should_refi_dp']
+)
+def compute_dp_threshold(df, mortgage30us, parameter_grid):
+    """
+    Full real-option refinance thresholds from the backward-induction model in `optimal_refi`,
+    one column per parameter set. Each parameter set is solved once on a grid and every loan-month
+    is looked up by remaining term, contract rate and transaction cost.
+    """
+    rate_vol = compute_mortgage_rate_vol(mortgage30us)
+    transaction_cost = 0.01 + 2000 / df['upb_curr'].to_numpy()
+    dp_threshold = np.column_stack([
+        interpolate_refi_threshold(
+            solve_refi_thresholds(float(parameters['PROB_MOVE']), float(parameters['ANNUAL_DISCOUNT_RATE']), float(parameters['MARGINAL_TAX_RATE']), float(rate_vol)),
+            time_to_maturity=df['time_to_maturity'].to_numpy(),
+            rate_orig=df['rate_orig'].to_numpy(),
+            transaction_cost=transaction_cost
+        )
+        for _, parameters in parameter_grid.iterrows()
+    ])
+    
+    columns = {}
+    columns['dp_threshold'] = dp_threshold
+    columns['dp_gap_adj'] = df['rate_gap_adj'].to_numpy()[:, None] - dp_threshold
+    columns['should_refi_dp'] = np.where(df['rate_gap_adj'].to_numpy()[:, None] > dp_threshold, 1, 0)
+    return columns
+
+@derives(
+    inputs=['loan_id', 'rate_orig', 'term', 'upb_orig'],
+    outputs=['annual_payment_orig']
+)
+def compute_annual_payment(df):
+    """Annual payment on the original loan, computed once per loan and broadcast to its rows."""
+    loans = df.loc[get_block_starts(df['loan_id']), ['rate_orig', 'term', 'upb_orig']]
+    annual_payment = compute_annuity(
+        interest_rate=(loans['rate_orig'].to_numpy() / 100),
+        term=loans['term'].to_numpy() / 12,
+        principal=loans['upb_orig'].to_numpy()
+    )
+    df['annual_payment_orig'] = annual_payment[get_block_index(df['loan_id'])]
     return df
 
 def compute_annuity(interest_rate=None, term=None, principal=None):
     """Compute monthly mortgage payment"""
-    return principal * (interest_rate * (1 + interest_rate)**term) / ((1 + interest_rate)**term - 1)
-
-def compute_mortgage_rate_vol(mortgage30us):
-    """Compute monthly mortgage rate volatility"""
-    monthly_mortgage_rate_vol = (
-        mortgage30us
-        .assign(dr=lambda x: x["mortgage_rate"].diff() / 100)
-        ["dr"]
-        .dropna()
-        .std() * np.sqrt(12)
-    )
-    return monthly_mortgage_rate_vol
+    return mortgage.annuity(interest_rate, term, principal)
 
-def compute_adl_gap(df, bin_size=0.2, min_bin = -4.0, max_bin = 4.0):
-    df['adl_gap'] = df['rate_gap'] - df['adl_threshold']
-    df['adl_gap_adj'] = df['rate_gap_adj'] - df['adl_threshold']
+@derives(
+    inputs=['rate_gap', 'rate_gap_adj', 'adl_threshold'],
+    outputs=['adl_gap', 'adl_gap_adj', 'adl_gap_bin', 'adl_gap_adj_bin']
+)
+def compute_adl_gap(df, adl_threshold, bin_size=0.2, min_bin = -4.0, max_bin = 4.0):
+    columns = {}
+    columns['adl_gap'] = df['rate_gap'].to_numpy()[:, None] - adl_threshold
+    columns['adl_gap_adj'] = df['rate_gap_adj'].to_numpy()[:, None] - adl_threshold
     
     bins = np.arange(min_bin, max_bin + bin_size, bin_size)
     bins = np.concatenate([[-np.inf], bins, [np.inf]])
-    df['adl_gap_bin'] = pd.cut(df['adl_gap'], bins=bins, right=False, include_lowest=True, labels=False)
-    df['adl_gap_adj_bin'] = pd.cut(df['adl_gap_adj'], bins=bins, right=False, include_lowest=True, labels=False)
-    return df
+    columns['adl_gap_bin'] = compute_bins(columns['adl_gap'], bins)
+    columns['adl_gap_adj_bin'] = compute_bins(columns['adl_gap_adj'], bins)
+    return columns
 
-def compute_should_refi(df):
-    df['should_refi'] = np.where(df['rate_gap_adj'] > df['adl_threshold'], 1, 0)
-    df['should_refi_adj'] = np.where(df['rate_gap_adj'] > df['adl_threshold'], 1, 0)
-    return df
+def compute_bins(values, bins):
+    """Array equivalent of pd.cut(values, bins, right=False, include_lowest=True, labels=False)."""
+    bin_index = (np.searchsorted(bins, values, side='right') - 1).astype(float)
+    bin_index[np.isnan(values) | (values >= bins[-1])] = np.nan
+    if not np.isnan(bin_index).any():
+        bin_index = bin_index.astype(int)
+    return bin_index
 
-def compute_savings(group):
-    group = group.copy() 
-    group['npv_never_refi'] = compute_npv_never_refi(group)
-    group['npv_optimal_refi'] = compute_npv_optimal_refi(group)
-    group['npv_realized_refi'] = compute_npv_realized_refi(group)
+@derives(
+    inputs=['rate_gap', 'rate_gap_adj', 'adl_threshold'],
+    outputs=['should_refi', 'should_refi_adj']
+)
+def compute_should_refi(df, adl_threshold):
+    columns = {}
+    columns['should_refi'] = np.where(df['rate_gap_adj'].to_numpy()[:, None] > adl_threshold, 1, 0)
+    columns['should_refi_adj'] = np.where(df['rate_gap_adj'].to_numpy()[:, None] > adl_threshold, 1, 0)
+    return columns
+
+@derives(
+    inputs=['loan_id', 'period', 'period_exit', 'should_refi'],
+    outputs=['months_since_should_refi', 'should_refi_streak', 'should_refi_longest_streak', 'exit_in_the_money']
+)
+def compute_refi_timing(df, should_refi):
+    """
+    Timing of `should_refi` for every loan-month, in one pass over the sorted loan blocks: months
+    since the loan first should have refinanced (NaN before then), the current and longest
+    in-the-money streaks to date, and whether the loan exited while in the money, i.e. should
+    have refinanced in the month before exit. Each column has one column per parameter set.
+    """
+    loan_ids = df['loan_id']
+    block = get_block_index(loan_ids)
+    period = df['period'].to_numpy()
+    in_the_money = should_refi == 1
+    
+    first_row = get_first_in_block(in_the_money, loan_ids)
+    first_period = np.where(first_row >= 0, period[np.maximum(first_row, 0)], np.nan)[block]
+    exit_row = get_first_in_block(period == (df['period_exit'].to_numpy() - 1), loan_ids)
+    exit_in_the_money = (exit_row[:, None] >= 0) & in_the_money[np.maximum(exit_row, 0)]
     
-    group['savings_optimal_refi'] =  group['npv_never_refi'] - group['npv_optimal_refi']
-    group['savings_realized_refi'] = group['npv_never_refi'] - group['npv_realized_refi']
-    group['savings_loss'] = group['savings_optimal_refi'] - group['savings_realized_refi']
-    return group
+    columns = {}
+    columns['months_since_should_refi'] = np.where(period[:, None] >= first_period, period[:, None] - first_period, np.nan)
+    columns['should_refi_streak'] = get_run_length(in_the_money, loan_ids)
+    columns['should_refi_longest_streak'] = get_block_cummax(columns['should_refi_streak'], loan_ids)
+    columns['exit_in_the_money'] = exit_in_the_money[block].astype(int)
+    return columns
+
+@derives(
+    inputs=['loan_id', 'period', 'period_exit', 'rate_orig', 'term', 'upb_orig', 'upb_curr', 'time_to_maturity', 'rate_mortgage30us_adj', 'should_refi_adj'],
+    outputs=['npv_never_refi', 'npv_optimal_refi', 'npv_realized_refi', 'savings_optimal_refi', 'savings_realized_refi', 'savings_loss']
+)
+def compute_savings(df, should_refi_adj, parameters={'ANNUAL_DISCOUNT_RATE': 0.05}):
+    """
+    Compute the never, optimal and realized refinance NPVs for all loans at once and broadcast
+    them to each loan's rows. Rows of a loan must be contiguous and sorted by period.
+    `should_refi_adj` has one column per parameter set, and so do the returned arrays.
+    """
+    loan_columns = compute_loan_savings(df, should_refi_adj, parameters=parameters)
+    block = get_block_index(df['loan_id'])
+    shape = should_refi_adj.shape
+    return {column: np.broadcast_to(expand_loan_values(values, should_refi_adj)[block], shape) for column, values in loan_columns.items()}
 
-def compute_npv_never_refi(group, parameters={'ANNUAL_DISCOUNT_RATE': 0.05}):
-    """Compute NPV of no refinance scenario."""
-    monthly_discount_rate = parameters['ANNUAL_DISCOUNT_RATE'] / 12
+def compute_loan_savings(df, should_refi_adj, parameters={'ANNUAL_DISCOUNT_RATE': 0.05}):
+    """Loan-level version of `compute_savings`: one row per loan instead of one per loan-month."""
+    loan_ids = df['loan_id']
+    loans = df.loc[get_block_starts(loan_ids), ['rate_orig', 'term', 'upb_orig', 'period_exit']].reset_index(drop=True)
+    loans['payment_orig'] = compute_annuity(
+        interest_rate=(loans['rate_orig'].to_numpy() / 100) / 12,
+        term=loans['term'].to_numpy(),
+        principal=loans['upb_orig'].to_numpy()
+    )
+    
+    optimal_refi_row = get_first_in_block(should_refi_adj == 1, loan_ids)
+    realized_refi_row = get_first_in_block(df['period'].to_numpy() == (df['period_exit'].to_numpy() - 1), loan_ids)
+    
+    columns = {}
+    columns['npv_never_refi'] = compute_npv_never_refi(loans, parameters=parameters)
+    columns['npv_optimal_refi'] = compute_npv_optimal_refi(df, loans, optimal_refi_row, parameters=parameters)
+    columns['npv_realized_refi'] = compute_npv_realized_refi(df, loans, realized_refi_row, parameters=parameters)
     
-    monthly_interest_rate_orig = (group['rate_orig'].iloc[0] / 100) / 12
-    term_orig = group['term'].iloc[0]
-    upb_orig = group['upb_orig'].iloc[0]
-    monthly_payment_orig = compute_annuity(interest_rate=monthly_interest_rate_orig, term=term_orig, principal=upb_orig)
+    npv_never_refi = expand_loan_values(columns['npv_never_refi'], should_refi_adj)
+    npv_realized_refi = expand_loan_values(columns['npv_realized_refi'], should_refi_adj)
+    columns['savings_optimal_refi'] =  npv_never_refi - columns['npv_optimal_refi']
+    columns['savings_realized_refi'] = npv_never_refi - npv_realized_refi
+    columns['savings_loss'] = columns['savings_optimal_refi'] - columns['savings_realized_refi']
+    return columns
+
+def compute_npv_never_refi(loans, parameters={'ANNUAL_DISCOUNT_RATE': 0.05}):
+    """Compute NPV of no refinance scenario for each loan."""
+    monthly_discount_rate = np.asarray(parameters['ANNUAL_DISCOUNT_RATE']) / 12
     
-    npv = monthly_payment_orig * ((1 - (1 + monthly_discount_rate)**(-term_orig) ) / monthly_discount_rate)
+    payment_orig = expand_loan_values(loans['payment_orig'].to_numpy(), monthly_discount_rate)
+    term = expand_loan_values(loans['term'].to_numpy(), monthly_discount_rate)
+    npv = mortgage.npv_payments(payment_orig, term, monthly_discount_rate)
     return npv
 
-def compute_npv_optimal_refi(group, parameters={'ANNUAL_DISCOUNT_RATE': 0.05}):
-    """Compute NPV of optimal refinance scenario."""
-    monthly_discount_rate = parameters['ANNUAL_DISCOUNT_RATE'] / 12
+def compute_npv_optimal_refi(df, loans, refi_row, parameters={'ANNUAL_DISCOUNT_RATE': 0.05}):
+    """Compute NPV of optimal refinance scenario for each loan, refinancing at its first `should_refi_adj` month."""
+    npv = compute_npv_refi(df, loans, refi_row, parameters=parameters)
+    npv_never_refi = expand_loan_values(compute_npv_never_refi(loans, parameters=parameters), refi_row)
+    return np.where(refi_row >= 0, npv, npv_never_refi)
+
+def compute_npv_realized_refi(df, loans, refi_row, parameters={'ANNUAL_DISCOUNT_RATE': 0.05}):
+    """Compute NPV of the realized refinance scenario for each loan, refinancing the month before exit."""
+    npv = compute_npv_refi(df, loans, refi_row, parameters=parameters)
+    npv = np.where(expand_loan_values(refi_row >= 0, npv), npv, np.nan)
+    no_exit = expand_loan_values(loans['period_exit'].isna().to_numpy(), npv)
+    return np.where(no_exit, compute_npv_never_refi(loans, parameters=parameters), npv)
+
+def compute_npv_refi(df, loans, refi_row, parameters={'ANNUAL_DISCOUNT_RATE': 0.05}):
+    """
+    Compute NPV of refinancing at `refi_row` for each loan. Loans without a refinance row are NaN.
+    `refi_row` may have extra columns (one per parameter set); loan terms are broadcast across them.
+    So may the discount rate, as a row with one column per parameter set.
+    """
+    monthly_discount_rate = np.asarray(parameters['ANNUAL_DISCOUNT_RATE']) / 12
     
-    monthly_interest_rate_orig = (group['rate_orig'].iloc[0] / 100) / 12
-    term_orig = group['term'].iloc[0]
-    upb_orig = group['upb_orig'].iloc[0]
-    monthly_payment_orig = compute_annuity(interest_rate=monthly_interest_rate_orig, term=term_orig, principal=upb_orig)
+    monthly_payment_orig = expand_loan_values(loans['payment_orig'].to_numpy(), refi_row)
+    term_orig = expand_loan_values(loans['term'].to_numpy(), refi_row)
     
-    mask = group['should_refi_adj'] == 1
-    if not mask.any():
-        npv = monthly_payment_orig * ((1 - (1 + monthly_discount_rate)**(-term_orig) ) / monthly_discount_rate)
-        return npv
+    has_refi = refi_row >= 0
+    refi_row = np.where(has_refi, refi_row, 0)
+    monthly_interest_rate_new = np.where(has_refi, (df['rate_mortgage30us_adj'].to_numpy()[refi_row] / 100) / 12, np.nan)
+    term_new = np.where(has_refi, df['time_to_maturity'].to_numpy()[refi_row], np.nan)
+    upb_new = np.where(has_refi, df['upb_curr'].to_numpy()[refi_row], np.nan)
+    
+    loan_values = [monthly_payment_orig, term_orig, monthly_interest_rate_new, term_new, upb_new]
+    npv = mortgage.npv_refi(*[expand_loan_values(values, monthly_discount_rate) for values in loan_values], monthly_discount_rate)
+    return npv
+
+def expand_loan_values(values, like):
+    """Reshape one value per loan so it broadcasts against `like`, which may have one column per parameter set."""
+    return values.reshape((-1,) + (1,) * (np.ndim(like) - np.ndim(values)) + values.shape[1:])
+
+@derives(
+    inputs=['period_orig', 'savings_optimal_refi', 'savings_realized_refi', 'savings_loss'],
+    outputs=['savings_optimal_refi_adj', 'savings_realized_refi_adj', 'savings_loss_adj']
+)
+def compute_inflation_adjustments(df, columns, cpi, cw_period_date, base_period='2025-01-01'):
+    _inflation_factor = compute_inflation_factor(df, cpi, cw_period_date, base_period=base_period)[:, None]
     
-    refi_period = group.loc[mask, 'period'].min()
-    monthly_interest_rate_new = ((group.loc[group['period'] == refi_period, 'rate_mortgage30us_adj'].item()) / 100) / 12
-    term_new = group.loc[group['period'] == refi_period, 'time_to_maturity'].item()
-    upb_new = group.loc[group['period'] == refi_period, 'upb_curr'].item()
-    monthly_payment_new = compute_annuity(interest_rate=monthly_interest_rate_new, term=term_new, principal=upb_new)
+    adjusted_columns = {}
+    adjusted_columns['savings_optimal_refi_adj'] = columns['savings_optimal_refi'] * _inflation_factor
+    adjusted_columns['savings_realized_refi_adj'] = columns['savings_realized_refi'] * _inflation_factor
+    adjusted_columns['savings_loss_adj'] = columns['savings_loss'] * _inflation_factor
+    return adjusted_columns
+
+def compute_inflation_factor(df, cpi, cw_period_date, base_period='2025-01-01'):
+    """Ratio of CPI in `base_period` to CPI in each row's origination period."""
+    cpi_series = PeriodSeries.from_frame(cpi, 'cpi', cw_period_date)
+    cpi_base = cpi_series[get_period(base_period, cw_period_date)]
+    return cpi_base / cpi_series[df['period_orig'].to_numpy()]
+
+def build_sweep_grid(grid_spec):
+    """Cartesian product of evenly spaced values for each parameter in `grid_spec`."""
+    values = {
+        parameter: np.round(np.linspace(spec['START'], spec['STOP'], spec['NUM']), 6)
+        for parameter, spec in grid_spec.items()
+    }
+    return pd.DataFrame(list(itertools.product(*values.values())), columns=list(values.keys()))
+
+SWEEP_COLUMNS = [
+    'loan_id', 'period', 'period_exit', 'rate_orig', 'term', 'upb_orig', 'upb_curr', 'time_to_maturity',
+    'rate_gap_adj', 'rate_mortgage30us_adj', 'annual_payment_orig'
+]
+_SWEEP_DATA = {}
+
+def run_sweep(df, mortgage30us, cpi, cw_period_date, sweep_grid, mask_full_sample, mask_refi_eligible, chunk_size=4, n_workers=1):
+    """
+    Evaluate savings for every parameter set in `sweep_grid` and reduce them to summary statistics.
+    Grid chunks are spread across processes. A worker holds loan-month arrays for at most
+    `chunk_size` parameter sets at a time and keeps only loan-level results. Unlike the loan-month
+    files, whose NPVs are discounted at 5%, each parameter set's NPVs are discounted at its own
+    ANNUAL_DISCOUNT_RATE, so the discount rate moves both the threshold and the savings.
+    """
+    loan_ids = df['loan_id']
+    starts = get_block_starts(loan_ids)
+    sweep_data = {
+        'df': df[SWEEP_COLUMNS],
+        'mortgage30us': mortgage30us,
+        'inflation_factor': compute_inflation_factor(df, cpi, cw_period_date)[starts],
+        'loan_masks': {
+            'full': get_first_in_block(mask_full_sample, loan_ids) >= 0,
+            'refi_eligible': get_first_in_block(mask_refi_eligible, loan_ids) >= 0
+        }
+    }
+    chunks = [sweep_grid.iloc[i:i + chunk_size] for i in range(0, len(sweep_grid), chunk_size)]
+    # workers are spawned: forking after the parallel numba kernels have started their thread pool hangs the run
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'), initializer=init_sweep_worker, initargs=(sweep_data,)) as executor:
+        results = list(executor.map(summarize_parameter_chunk, chunks))
+    return pd.concat(results, ignore_index=True)
+
+def init_sweep_worker(sweep_data):
+    _SWEEP_DATA.update(sweep_data)
+
+def summarize_parameter_chunk(parameter_grid, sweep_data=None):
+    """Loan-level savings for a chunk of parameter sets, summarized by sample."""
+    sweep_data = sweep_data or _SWEEP_DATA
+    loan_columns = compute_loan_parameter_columns(
+        sweep_data['df'], sweep_data['mortgage30us'], parameter_grid, sweep_data['inflation_factor'],
+        discount_by_parameter=True
+    )
     
-    npv_orig = monthly_payment_orig * ((1 - (1 + monthly_discount_rate)**(-(term_orig - term_new)) ) / monthly_discount_rate)
-    npv_new = monthly_payment_new * ((1 - (1 + monthly_discount_rate)**(-term_new) ) / monthly_discount_rate) * ((1 + monthly_discount_rate)**(-(term_orig - term_new)))
-    npv_transaction_cost = (0.01 * upb_new + 2000) * ((1 + monthly_discount_rate)**(-(term_orig - term_new)))
+    summaries = []
+    for sample, loan_mask in sweep_data['loan_masks'].items():
+        summary = pd.DataFrame({
+            'annual_discount_rate': parameter_grid['ANNUAL_DISCOUNT_RATE'].to_numpy(),
+            'prob_move': parameter_grid['PROB_MOVE'].to_numpy(),
+            'marginal_tax_rate': parameter_grid['MARGINAL_TAX_RATE'].to_numpy(),
+            'sample': sample,
+            'n_loans': loan_mask.sum(),
+            'mean_savings_optimal_refi_adj': np.nanmean(loan_columns['savings_optimal_refi_adj'][loan_mask], axis=0),
+            'mean_savings_realized_refi_adj': np.nanmean(loan_columns['savings_realized_refi_adj'][loan_mask], axis=0),
+            'mean_savings_loss_adj': np.nanmean(loan_columns['savings_loss_adj'][loan_mask], axis=0),
+            'median_savings_loss_adj': np.nanmedian(loan_columns['savings_loss_adj'][loan_mask], axis=0),
+            'share_should_refi': loan_columns['should_refi_ever'][loan_mask].mean(axis=0)
+        })
+        summaries.append(summary)
+    return pd.concat(summaries, ignore_index=True)
+
+def compute_loan_parameter_columns(df, mortgage30us, parameter_grid, inflation_factor, discount_by_parameter=False):
+    """
+    Inflation-adjusted savings and whether the loan should ever have refinanced, one row per loan
+    and one column per parameter set. Loan-month arrays are dropped as soon as they are reduced.
+    NPVs are discounted at the default rate of `compute_savings`, as in the loan-month files, unless
+    `discount_by_parameter`, which discounts each column at its parameter set's ANNUAL_DISCOUNT_RATE.
+    """
+    adl_threshold = compute_adl_threshold(df, mortgage30us, parameter_grid)
+    should_refi_adj = compute_should_refi(df, adl_threshold)['should_refi_adj']
+    del adl_threshold
+    if discount_by_parameter:
+        loan_columns = compute_loan_savings(df, should_refi_adj, parameters={'ANNUAL_DISCOUNT_RATE': parameter_grid['ANNUAL_DISCOUNT_RATE'].to_numpy()[None, :]})
+    else:
+        loan_columns = compute_loan_savings(df, should_refi_adj)
+    should_refi_ever = get_first_in_block(should_refi_adj == 1, df['loan_id']) >= 0
+    del should_refi_adj
     
-    npv = npv_orig + npv_new + npv_transaction_cost
-    return npv
+    _inflation_factor = inflation_factor[:, None]
+    savings_optimal_refi_adj = loan_columns['savings_optimal_refi'] * _inflation_factor
+    return {
+        'savings_optimal_refi_adj': savings_optimal_refi_adj,
+        'savings_realized_refi_adj': np.broadcast_to(loan_columns['savings_realized_refi'] * _inflation_factor, savings_optimal_refi_adj.shape),
+        'savings_loss_adj': loan_columns['savings_loss'] * _inflation_factor,
+        'should_refi_ever': should_refi_ever
+    }
 
-def compute_npv_realized_refi(group, parameters={'ANNUAL_DISCOUNT_RATE': 0.05}):
-    """Compute NPV of the realized refinance scenario."""
-    monthly_discount_rate = parameters['ANNUAL_DISCOUNT_RATE'] / 12
-    
-    monthly_interest_rate_orig = (group['rate_orig'].iloc[0] / 100) / 12
-    term_orig = group['term'].iloc[0]
-    upb_orig = group['upb_orig'].iloc[0]
-    monthly_payment_orig = compute_annuity(interest_rate=monthly_interest_rate_orig, term=term_orig, principal=upb_orig)
-    
-    if group['period_exit'].isna().all():
-        npv = monthly_payment_orig * ((1 - (1 + monthly_discount_rate)**(-term_orig) ) / monthly_discount_rate)
-        return npv
-    
-    refi_period = group['period_exit'].iloc[0] - 1
-    monthly_interest_rate_new = ((group.loc[group['period'] == refi_period, 'rate_mortgage30us_adj'].item()) / 100) / 12
-    term_new = group.loc[group['period'] == refi_period, 'time_to_maturity'].item()
-    upb_new = group.loc[group['period'] == refi_period, 'upb_curr'].item()
-    monthly_payment_new = compute_annuity(interest_rate=monthly_interest_rate_new, term=term_new, principal=upb_new)
-    
-    npv_orig = monthly_payment_orig * ((1 - (1 + monthly_discount_rate)**(-(term_orig - term_new)) ) / monthly_discount_rate)
-    npv_new = monthly_payment_new * ((1 - (1 + monthly_discount_rate)**(-term_new) ) / monthly_discount_rate) * ((1 + monthly_discount_rate)**(-(term_orig - term_new)))
-    npv_transaction_cost = (0.01 * upb_new + 2000) * ((1 + monthly_discount_rate)**(-(term_orig - term_new)))
-    npv = npv_orig + npv_new + npv_transaction_cost
-    return npv
+STREAM_LOAN_COLUMNS = {
+    'parameter_type': 'object',
+    'in_full': 'bool',
+    'in_refi_eligible': 'bool',
+    'savings_optimal_refi_adj': 'float64',
+    'savings_realized_refi_adj': 'float64',
+    'savings_loss_adj': 'float64',
+    'should_refi_ever': 'bool'
+}
 
-def compute_inflation_adjustments(df, cpi, cw_period_date, base_period='2025-01-01'):
-    cpi_period = cpi.merge(cw_period_date, left_on='date', right_index=True, how='left')
-    df['cpi_base'] = cpi_period.loc[cpi['date'] == base_period, 'cpi'].item()
-    df = df.merge(cpi_period.rename(columns={'cpi': 'cpi_at_orig', 'period': 'period_orig'}).drop(columns=['date']), on='period_orig', how='left')
+def run_stream(ddf, mortgage30us, cpi, cw_period_date, parameter_grid, out_dir, rate_spread_spec=None):
+    """
+    Process the full loan population without holding it in memory. A first pass over one row per
+    loan fits the rate spread; a second pass shuffles loan-months so each loan sits in a single
+    partition, runs every stage partition by partition and writes one row per loan and parameter
+    set to `out_dir`. Returns savings means by parameter set and sample, computed in the same pass.
+    """
+    rate_spread_spec = rate_spread_spec or {'COVARIATES': [], 'FIXED_EFFECTS': []}
+    loan_columns = list(dict.fromkeys(['loan_id', 'period', 'period_orig', 'rate_orig'] + rate_spread_spec['COVARIATES'] + rate_spread_spec['FIXED_EFFECTS']))
+    loans = ddf[loan_columns].drop_duplicates(subset=['loan_id'])
+    levels = {column: sorted(values) for column, values in dask.compute({column: loans[column].dropna().unique() for column in rate_spread_spec['FIXED_EFFECTS']})[0].items()}
+    moments = dask.compute(*[
+        dask.delayed(lambda x: compute_rate_spread_moments(add_fred(x.copy(), mortgage30us, cpi, cw_period_date), rate_spread_spec, levels))(partition)
+        for partition in loans.to_delayed()
+    ])
+    rate_spread_model = fit_rate_spread(moments, levels)
     
-    df['savings_optimal_refi_adj'] = df['savings_optimal_refi'] * (df['cpi_base'] / df['cpi_at_orig'])
-    df['savings_realized_refi_adj'] = df['savings_realized_refi'] * (df['cpi_base'] / df['cpi_at_orig'])
-    df['savings_loss_adj'] = df['savings_loss'] * (df['cpi_base'] / df['cpi_at_orig'])
-    df = df.drop(columns=['cpi_base', 'cpi_at_orig'])
-    return df
+    ddf_loans = ddf.shuffle(on='loan_id').map_partitions(
+        process_loan_partition,
+        mortgage30us, cpi, cw_period_date, parameter_grid, rate_spread_spec, rate_spread_model,
+        meta={'loan_id': ddf['loan_id'].dtype, **STREAM_LOAN_COLUMNS}
+    )
+    write = ddf_loans.to_parquet(
+        out_dir,
+        engine = "pyarrow",
+        compression = "snappy",
+        partition_on = ['parameter_type'],
+        write_index = False,
+        overwrite = True,
+        compute = False
+    )
+    summaries = {
+        sample: ddf_loans[ddf_loans[f'in_{sample}']].groupby('parameter_type').agg(
+            n_loans=('loan_id', 'count'),
+            mean_savings_optimal_refi_adj=('savings_optimal_refi_adj', 'mean'),
+            mean_savings_realized_refi_adj=('savings_realized_refi_adj', 'mean'),
+            mean_savings_loss_adj=('savings_loss_adj', 'mean'),
+            share_should_refi=('should_refi_ever', 'mean')
+        )
+        for sample in ['full', 'refi_eligible']
+    }
+    _, summaries = dask.compute(write, summaries)
+    return pd.concat(
+        [summary.reset_index().assign(sample=sample) for sample, summary in summaries.items()],
+        ignore_index=True
+    )
+
+def process_loan_partition(df, mortgage30us, cpi, cw_period_date, parameter_grid, rate_spread_spec, rate_spread_model):
+    """Run all stages on a partition holding every loan-month of its loans and return one row per loan and parameter set."""
+    if df.empty:
+        columns = {'loan_id': df['loan_id'].dtype, **STREAM_LOAN_COLUMNS}
+        return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in columns.items()})
+    df = df.sort_values(['loan_id', 'period']).reset_index(drop=True)
+    df = add_fred(df, mortgage30us, cpi, cw_period_date)
+    df = impute_current_upb(df)
+    df = compute_rate_spread(df, spec=rate_spread_spec, model=rate_spread_model)
+    df = compute_rate_gap(df)
+    df = compute_annual_payment(df)
+    
+    loan_ids = df['loan_id']
+    starts = get_block_starts(loan_ids)
+    mask_full_sample, mask_refi_eligible = compute_sample_masks(df)
+    loan_columns = compute_loan_parameter_columns(
+        df[SWEEP_COLUMNS], mortgage30us, parameter_grid,
+        compute_inflation_factor(df, cpi, cw_period_date)[starts]
+    )
+    
+    n_loans, n_parameters = starts.sum(), len(parameter_grid)
+    return pd.DataFrame({
+        'loan_id': np.tile(loan_ids.to_numpy()[starts], n_parameters),
+        'parameter_type': np.repeat(parameter_grid.index.to_numpy(), n_loans).astype(object),
+        'in_full': np.tile(get_first_in_block(mask_full_sample, loan_ids) >= 0, n_parameters),
+        'in_refi_eligible': np.tile(get_first_in_block(mask_refi_eligible, loan_ids) >= 0, n_parameters),
+        **{column: values.T.ravel() for column, values in loan_columns.items()}
+    })
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,178 @@
+import json
+import numpy as np
+import pandas as pd
+from pathlib import Path
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from source.lib.helpers import mortgage
+from source.lib.helpers.cluster import get_cluster_config
+from source.lib.helpers.market_data import compute_mortgage_rate_vol
+from source.lib.helpers.utils import get_block_starts
+from source.lib.save_data import save_data
+
+SIMULATION_COLUMNS = [
+    'loan_id', 'rate_orig', 'upb_orig', 'term', 'time_from_orig', 'time_to_maturity',
+    'rate_mortgage30us_adj', 'annual_payment_orig'
+]
+# savings NPVs are discounted at the default rate of compute_savings in process_fannie_mae
+NPV_ANNUAL_DISCOUNT_RATE = 0.05
+RATE_FLOOR = 0.5
+SAVINGS_BINS = np.arange(-100000, 500000 + 100, 100)
+_SIMULATION_DATA = {}
+
+def main():
+    with open('source/lib/config.json', 'r') as f:
+        CONFIG = json.load(f)
+    with open('source/lib/parameters.json', 'r') as f:
+        PARAMETER_LIST = json.load(f)
+    SIMULATION = CONFIG['SIMULATION']
+
+    INDIR = Path('datastore/output/derived/fannie_mae')
+    INDIR_FRED = Path('output/derived/fred')
+    OUTDIR = Path('datastore/output/derived/fannie_mae')
+
+    mortgage30us = pd.read_csv(INDIR_FRED / 'mortgage30us.csv', parse_dates=['date'])
+    rate_offsets = simulate_rate_offsets(mortgage30us, n_paths=SIMULATION['N_PATHS'], n_months=360, random_state=CONFIG['SEED'])
+
+    overall_list = []
+    for PARAMETER_TYPE, PARAMETERS in PARAMETER_LIST.items():
+        df = pd.read_parquet(INDIR / f'sflp_sample_processed_{PARAMETER_TYPE.lower()}.parquet', columns=SIMULATION_COLUMNS)
+        loans = df.loc[get_block_starts(df['loan_id'])].reset_index(drop=True)
+
+        df_loans, df_overall = run_simulation(
+            loans, rate_offsets, PARAMETERS,
+            rate_vol=compute_mortgage_rate_vol(mortgage30us),
+            quantiles=SIMULATION['QUANTILES'],
+            chunk_size=SIMULATION['LOAN_CHUNK_SIZE'],
+            n_workers=get_cluster_config(CONFIG)['N_WORKERS']
+        )
+        save_data(
+            df_loans,
+            keys = ['loan_id'],
+            out_file = OUTDIR / f'sflp_sample_simulated_savings_{PARAMETER_TYPE.lower()}.parquet',
+            log_file = OUTDIR / f'sflp_sample_simulated_savings_{PARAMETER_TYPE.lower()}.log',
+            sortbykey = True
+        )
+        overall_list.append(df_overall.assign(parameter_type=PARAMETER_TYPE.lower()))
+
+    save_data(
+        pd.concat(overall_list, ignore_index=True),
+        keys = ['parameter_type', 'statistic'],
+        out_file = OUTDIR / 'sflp_sample_simulated_savings_overall.parquet',
+        log_file = OUTDIR / 'sflp_sample_simulated_savings_overall.log',
+        sortbykey = True
+    )
+
+def simulate_rate_offsets(mortgage30us, n_paths=1000, n_months=360, random_state=123):
+    """
+    Simulated changes in the mortgage rate, in percentage points, `k` months after the start of
+    each path. Monthly changes are normal with the standard deviation of historical monthly changes
+    in MORTGAGE30US. Every loan is evaluated on the same paths.
+    """
+    monthly_vol = mortgage30us['mortgage_rate'].diff().dropna().std()
+    shocks = np.random.default_rng(random_state).normal(0, monthly_vol, size=(n_paths, n_months))
+    shocks[:, 0] = 0
+    return np.cumsum(shocks, axis=1)
+
+def run_simulation(loans, rate_offsets, parameters, rate_vol, quantiles, chunk_size=500, n_workers=1):
+    """
+    Savings from following the ADL rule on every simulated path, for every loan. Loan chunks are
+    spread across processes and each holds at most `chunk_size` loans by the number of paths.
+    Returns per-loan quantiles across paths and overall quantiles across loans and paths, the
+    latter read off a histogram with $100 bins.
+    """
+    simulation_data = {
+        'rate_offsets': rate_offsets,
+        'parameters': parameters,
+        'rate_vol': rate_vol,
+        'quantiles': quantiles
+    }
+    chunks = [loans.iloc[i:i + chunk_size] for i in range(0, len(loans), chunk_size)]
+    # workers are spawned: forking after the parallel numba kernels have started their thread pool hangs the run
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'), initializer=init_simulation_worker, initargs=(simulation_data,)) as executor:
+        results = list(executor.map(simulate_loan_chunk, chunks))
+
+    df_loans = pd.concat([result['loans'] for result in results], ignore_index=True)
+    counts = sum(result['counts'] for result in results)
+    total = sum(result['total'] for result in results)
+    df_overall = pd.DataFrame({
+        'statistic': ['mean'] + [f'q{quantile:g}' for quantile in quantiles],
+        'savings': [total / counts.sum()] + list(compute_histogram_quantiles(counts, SAVINGS_BINS, quantiles))
+    })
+    return df_loans, df_overall
+
+def init_simulation_worker(simulation_data):
+    _SIMULATION_DATA.update(simulation_data)
+
+def simulate_loan_chunk(loans, simulation_data=None):
+    """Simulate the refinancing decisions and savings of a chunk of loans on every path."""
+    simulation_data = simulation_data or _SIMULATION_DATA
+    savings, refi_month = simulate_savings(loans, simulation_data['rate_offsets'], simulation_data['parameters'], simulation_data['rate_vol'])
+
+    quantiles = simulation_data['quantiles']
+    df_loans = pd.DataFrame({
+        'loan_id': loans['loan_id'].to_numpy(),
+        'share_paths_refi': (refi_month >= 0).mean(axis=1),
+        'mean_savings': savings.mean(axis=1),
+        **{f'savings_q{quantile:g}': values for quantile, values in zip(quantiles, np.quantile(savings, quantiles, axis=1))}
+    })
+    return {
+        'loans': df_loans,
+        'counts': np.histogram(np.clip(savings, SAVINGS_BINS[0], SAVINGS_BINS[-1]), bins=SAVINGS_BINS)[0],
+        'total': savings.sum()
+    }
+
+def simulate_savings(loans, rate_offsets, parameters, rate_vol):
+    """
+    Savings per loan and path from refinancing at the first month the rate gap exceeds the ADL
+    threshold, and that month (-1 if never). Paths start at each loan's first observed month and
+    market rate. Memory is a few arrays of loans by paths: the balance schedule is generated one
+    month at a time rather than for every month of every loan.
+    """
+    n_paths, n_months = rate_offsets.shape
+    rate_orig = loans['rate_orig'].to_numpy()
+    term = loans['term'].to_numpy()
+    upb_orig = loans['upb_orig'].to_numpy()
+    remaining_start = loans['time_to_maturity'].to_numpy()
+    annual_payment = loans['annual_payment_orig'].to_numpy()
+    rate_start = loans['rate_mortgage30us_adj'].to_numpy()[:, None]
+
+    refi_month = np.full((len(loans), n_paths), -1)
+    refi_rate = np.full((len(loans), n_paths), np.nan)
+    refi_balance = np.full((len(loans), n_paths), np.nan)
+    schedule = mortgage.iter_amortization(
+        rate_orig / 1200, term, upb_orig, loan_age=loans['time_from_orig'].to_numpy(),
+        n_months=min(n_months, int(np.nanmax(remaining_start, initial=0)))
+    )
+    for k, month in schedule:
+        # the balance reaches zero at maturity; thresholds past it are never used
+        with np.errstate(divide='ignore', invalid='ignore'):
+            threshold = mortgage.adl_threshold(
+                month['balance'], annual_payment, rate_orig, rate_vol,
+                parameters['ANNUAL_DISCOUNT_RATE'], parameters['PROB_MOVE'], parameters['MARGINAL_TAX_RATE']
+            )
+        market_rate = np.maximum(rate_start + rate_offsets[None, :, k], RATE_FLOOR)
+        refinance = (refi_month < 0) & (k < remaining_start)[:, None] & (rate_orig[:, None] - market_rate > threshold[:, None])
+        refi_month[refinance] = k
+        refi_rate[refinance] = market_rate[refinance]
+        refi_balance[refinance] = np.broadcast_to(month['balance'][:, None], refinance.shape)[refinance]
+
+    has_refi = refi_month >= 0
+    payment = mortgage.annuity(rate_orig / 1200, term, upb_orig)
+    monthly_discount_rate = NPV_ANNUAL_DISCOUNT_RATE / 12
+    npv_never_refi = mortgage.npv_payments(payment, remaining_start, monthly_discount_rate)[:, None]
+    npv_refi = mortgage.npv_refi(
+        payment[:, None], remaining_start[:, None], refi_rate / 1200, remaining_start[:, None] - np.maximum(refi_month, 0),
+        refi_balance, monthly_discount_rate
+    )
+    savings = np.where(has_refi, npv_never_refi - npv_refi, 0)
+    return savings, refi_month
+
+def compute_histogram_quantiles(counts, bins, quantiles):
+    """Quantiles of the values summarized by a histogram, interpolating within bins."""
+    cumulative = np.concatenate([[0], np.cumsum(counts)])
+    return np.interp(np.asarray(quantiles) * cumulative[-1], cumulative, bins)
+
+if __name__ == '__main__':
+    main()
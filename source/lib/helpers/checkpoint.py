@@ -0,0 +1,86 @@
+import os
+import json
+import hashlib
+import inspect
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+def hash_frame(df):
+    """Hash the contents of a DataFrame, including its index, column names and dtypes."""
+    digest = hashlib.md5()
+    digest.update(json.dumps([(str(column), str(dtype)) for column, dtype in df.dtypes.items()]).encode())
+    digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def hash_code(*funcs):
+    """Hash the source of a stage and of the functions (or modules) it calls, so that editing any of them invalidates the stage."""
+    digest = hashlib.md5()
+    for func in funcs:
+        digest.update(inspect.getsource(func).encode())
+    return digest.hexdigest()
+
+def get_stage_key(stage, input_key, args=(), depends_on=(), parameters=None):
+    """
+    Content address of a stage's output: the key of its input data, the hash of any DataFrame
+    arguments, the stage code version and the parameters the stage reads.
+    """
+    key = {
+        'stage': stage.__name__,
+        'input': input_key,
+        'args': [hash_frame(arg) if isinstance(arg, pd.DataFrame) else repr(arg) for arg in args],
+        'code': hash_code(stage, *depends_on),
+        'parameters': parameters or {}
+    }
+    return hashlib.md5(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+def run_stage(stage, df, *args, input_key=None, cache_dir=None, depends_on=(), parameters=None):
+    """
+    Run `stage(df, *args)` or load its output from `cache_dir`. `input_key` identifies `df`: the
+    key returned by the previous stage, or `hash_frame` of the raw input. Returns the output and
+    its key so that stages can be chained without rehashing. With no `cache_dir` the stage always runs.
+    """
+    if cache_dir is None:
+        return stage(df, *args), None
+    key = get_stage_key(stage, input_key, args=args, depends_on=depends_on, parameters=parameters)
+    cache_file = Path(cache_dir) / f'{stage.__name__}-{key}.parquet'
+    if cache_file.exists():
+        return pd.read_parquet(cache_file), key
+
+    df = stage(df, *args)
+    write_atomic(cache_file, lambda f: df.to_parquet(f, engine='pyarrow', index=False))
+    return df, key
+
+def run_parameter_stage(stage, df, *args, parameter_grid, input_key=None, cache_dir=None, depends_on=()):
+    """
+    Run a stage returning one column per parameter set, `stage(df, *args, parameter_grid)`, caching
+    each parameter set separately. Only the parameter sets without a cached result are computed, so
+    editing one set in parameters.json recomputes only that set.
+    """
+    if cache_dir is None:
+        return stage(df, *args, parameter_grid)
+
+    cache_files = [
+        Path(cache_dir) / f'{stage.__name__}-{get_stage_key(stage, input_key, args=args, depends_on=depends_on, parameters=parameters.to_dict())}.npz'
+        for _, parameters in parameter_grid.iterrows()
+    ]
+    missing = [i for i, cache_file in enumerate(cache_files) if not cache_file.exists()]
+    if missing:
+        columns = stage(df, *args, parameter_grid.iloc[missing])
+        for j, i in enumerate(missing):
+            write_atomic(cache_files[i], lambda f: np.savez(f, **{column: values[:, j] for column, values in columns.items()}))
+
+    parameter_columns = []
+    for cache_file in cache_files:
+        with np.load(cache_file) as cached:
+            parameter_columns.append({column: cached[column] for column in cached.files})
+    return {column: np.column_stack([columns[column] for columns in parameter_columns]) for column in parameter_columns[0]}
+
+def write_atomic(path, write):
+    """Write through a temporary file so that an interrupted run never leaves a partial cache entry."""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
@@ -0,0 +1,55 @@
+import os
+from contextlib import contextmanager
+from dask.distributed import Client, LocalCluster
+
+ENV_OVERRIDES = {
+    'N_WORKERS': ('CLUSTER_N_WORKERS', int),
+    'THREADS_PER_WORKER': ('CLUSTER_THREADS_PER_WORKER', int),
+    'MEMORY_LIMIT': ('CLUSTER_MEMORY_LIMIT', str),
+    'SCHEDULER_ADDRESS': ('CLUSTER_SCHEDULER_ADDRESS', str)
+}
+
+def get_cluster_config(config):
+    """
+    Read cluster settings from the `CLUSTER` block of config.json.
+    Environment variables (`CLUSTER_N_WORKERS`, `CLUSTER_THREADS_PER_WORKER`,
+    `CLUSTER_MEMORY_LIMIT`, `CLUSTER_SCHEDULER_ADDRESS`) take precedence.
+    """
+    cluster_config = {
+        'N_WORKERS': 32,
+        'THREADS_PER_WORKER': 1,
+        'MEMORY_LIMIT': '16 GiB',
+        'SCHEDULER_ADDRESS': None
+    }
+    cluster_config.update(config.get('CLUSTER', {}))
+    for key, (env_var, cast) in ENV_OVERRIDES.items():
+        if os.environ.get(env_var):
+            cluster_config[key] = cast(os.environ[env_var])
+    return cluster_config
+
+@contextmanager
+def get_client(config):
+    """
+    Yield a dask client. If a scheduler address is configured, attach to that
+    cluster and leave it running on exit; otherwise start a LocalCluster sized
+    from the config and shut it down on exit.
+    """
+    cluster_config = get_cluster_config(config)
+    if cluster_config['SCHEDULER_ADDRESS']:
+        client = Client(cluster_config['SCHEDULER_ADDRESS'])
+        try:
+            yield client
+        finally:
+            client.close()
+    else:
+        cluster = LocalCluster(
+            n_workers=cluster_config['N_WORKERS'],
+            threads_per_worker=cluster_config['THREADS_PER_WORKER'],
+            memory_limit=cluster_config['MEMORY_LIMIT']
+        )
+        client = Client(cluster)
+        try:
+            yield client
+        finally:
+            client.close()
+            cluster.close()
@@ -0,0 +1,23 @@
+def derives(inputs=(), outputs=()):
+    """Declare the columns a stage reads and the columns it adds, for `plan_stages`."""
+    def decorate(stage):
+        stage.inputs = list(inputs)
+        stage.outputs = list(outputs)
+        return stage
+    return decorate
+
+def plan_stages(stages, targets=None):
+    """
+    The stages, in their given order, needed to produce the `targets` columns, and every column the
+    plan reads or produces. `stages` must be in dependency order. Columns no stage outputs are taken
+    to be input columns. With no `targets` every stage runs.
+    """
+    if targets is None:
+        return list(stages), {column for stage in stages for column in stage.inputs + stage.outputs}
+    needed = set(targets)
+    plan = []
+    for stage in reversed(stages):
+        if needed & set(stage.outputs):
+            plan.append(stage)
+            needed |= set(stage.inputs)
+    return plan[::-1], needed
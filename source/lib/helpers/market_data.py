@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+
+class PeriodSeries:
+    """
+    A monthly series stored as a dense array indexed by integer period, so that looking up
+    values for every loan-month is positional indexing rather than a merge.
+    `series[periods]` returns the value at each period, or NaN where the period is missing or
+    outside the series.
+    """
+    def __init__(self, values, first_period):
+        self.values = np.asarray(values, dtype=float)
+        self.first_period = int(first_period)
+
+    @classmethod
+    def from_frame(cls, df, value_column, cw_period_date):
+        """Build from a frame with a `date` column, mapping dates to periods with `cw_period_date`."""
+        df_period = (
+            df[['date', value_column]]
+            .merge(cw_period_date, left_on='date', right_index=True, how='inner')
+            .dropna(subset=['period'])
+        )
+        periods = df_period['period'].to_numpy().astype(int)
+        if len(periods) == 0:
+            return cls(np.empty(0), 0)
+        first_period = periods.min()
+        values = np.full(periods.max() - first_period + 1, np.nan)
+        values[periods - first_period] = df_period[value_column].to_numpy()
+        return cls(values, first_period)
+
+    def __getitem__(self, periods):
+        periods = np.asarray(periods, dtype=float)
+        if len(self.values) == 0:
+            return np.full(periods.shape, np.nan)
+        position = periods - self.first_period
+        valid = ~np.isnan(position) & (position >= 0) & (position < len(self.values))
+        return np.where(valid, self.values[np.where(valid, position, 0).astype(int)], np.nan)
+
+    def __len__(self):
+        return len(self.values)
+
+def load_market_data(mortgage30us, cpi, cw_period_date):
+    """FRED series used by the pipeline, as period-indexed series."""
+    return {
+        'mortgage_rate': PeriodSeries.from_frame(mortgage30us, 'mortgage_rate', cw_period_date),
+        'cpi': PeriodSeries.from_frame(cpi, 'cpi', cw_period_date)
+    }
+
+def compute_mortgage_rate_vol(mortgage30us):
+    """Compute monthly mortgage rate volatility"""
+    monthly_mortgage_rate_vol = (
+        mortgage30us
+        .assign(dr=lambda x: x["mortgage_rate"].diff() / 100)
+        ["dr"]
+        .dropna()
+        .std() * np.sqrt(12)
+    )
+    return monthly_mortgage_rate_vol
+
+def get_period(date, cw_period_date):
+    """Integer period of a single date."""
+    return int(cw_period_date.loc[pd.Timestamp(date), 'period'])
@@ -0,0 +1,133 @@
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# set to False to force the NumPy implementations, e.g. to compare against them
+USE_NUMBA = numba is not None
+
+def annuity(interest_rate, term, principal):
+    """Payment per period on `principal` at `interest_rate` per period over `term` periods."""
+    return _dispatch(_annuity_kernel, _annuity, interest_rate, term, principal)
+
+def current_upb(loan_age, monthly_interest_rate, term, principal):
+    """Scheduled balance after `loan_age` payments of a level-payment loan."""
+    return _dispatch(_current_upb_kernel, _current_upb, loan_age, monthly_interest_rate, term, principal)
+
+def amortization(loan_age, monthly_interest_rate, term, principal):
+    """
+    Scheduled payment, and the interest, principal and balance after payment number `loan_age`,
+    for any mix of loans and ages in one call. Ages are clamped to [0, term]: at age 0 and past
+    maturity no payment is split, so interest and principal are 0.
+    """
+    loan_age = np.asarray(loan_age, dtype=float)
+    has_payment = (loan_age >= 1) & (loan_age <= term)
+    loan_age = np.clip(loan_age, 0, term)
+    balance = current_upb(loan_age, monthly_interest_rate, term, principal)
+    balance_before = current_upb(np.maximum(loan_age - 1, 0), monthly_interest_rate, term, principal)
+    return {
+        'payment': annuity(monthly_interest_rate, term, principal),
+        'interest': np.where(has_payment, monthly_interest_rate * balance_before, 0),
+        'principal': np.where(has_payment, balance_before - balance, 0),
+        'balance': balance
+    }
+
+def iter_amortization(monthly_interest_rate, term, principal, loan_age=0, n_months=None):
+    """
+    Generate the schedule of `amortization` month by month, starting at `loan_age` (one age per
+    loan), so that only one month of every loan is held at a time. Yields the month offset and the
+    schedule at `loan_age` plus that offset. By default runs until the last loan matures.
+    """
+    loan_age = np.asarray(loan_age, dtype=float)
+    if n_months is None:
+        n_months = int(np.nanmax(np.asarray(term) - loan_age, initial=0)) + 1
+    for k in range(n_months):
+        yield k, amortization(loan_age + k, monthly_interest_rate, term, principal)
+
+def npv_payments(payment, n_payments, discount_rate):
+    """Present value of `n_payments` level payments at `discount_rate` per period."""
+    return _dispatch(_npv_payments_kernel, _npv_payments, payment, n_payments, discount_rate)
+
+def npv_refi(payment_orig, term_orig, interest_rate_new, term_new, upb_new, discount_rate):
+    """
+    Present value of paying the original loan until `term_new` payments remain, then refinancing
+    the balance `upb_new` into a new loan at `interest_rate_new` over `term_new`, plus the
+    transaction cost of 1% of the balance and $2,000.
+    """
+    return _dispatch(_npv_refi_kernel, _npv_refi, payment_orig, term_orig, interest_rate_new, term_new, upb_new, discount_rate)
+
+def adl_threshold(upb, annual_payment, rate_orig, rate_vol, annual_discount_rate, prob_move, marginal_tax_rate):
+    """
+    Agarwal, Driscoll, Laibson (2013) square-root rule: the rate gap, in percentage points, above
+    which refinancing is optimal. `rate_vol` is the annualized volatility of the mortgage rate.
+    Arguments broadcast, so parameters may carry one column per parameter set.
+    """
+    transaction_cost = 0.01 * upb + 2000
+    _lambda = prob_move + ((annual_payment / upb) - (rate_orig / 100)) + 0.03
+    return 100 * np.sqrt((rate_vol * transaction_cost) / (upb * (1 - marginal_tax_rate))) * np.sqrt(2 * (annual_discount_rate + _lambda))
+
+def _dispatch(kernel, numpy_func, *args):
+    """
+    Run the compiled kernel on broadcast, flattened float arrays, or the NumPy function if Numba is
+    unavailable. Both paths take float arrays, so division by zero gives inf or NaN in either.
+    """
+    args = [np.asarray(arg, dtype=float) for arg in args]
+    if not USE_NUMBA:
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            return numpy_func(*args)
+    arrays = np.broadcast_arrays(*args)
+    shape = arrays[0].shape
+    out = np.empty(int(np.prod(shape)))
+    kernel(*[np.ascontiguousarray(array).ravel() for array in arrays], out)
+    return out.reshape(shape)
+
+def _annuity(interest_rate, term, principal):
+    return principal * (interest_rate * (1 + interest_rate)**term) / ((1 + interest_rate)**term - 1)
+
+def _current_upb(loan_age, monthly_interest_rate, term, principal):
+    return principal * ((1 + monthly_interest_rate)**term - (1 + monthly_interest_rate)**loan_age) / ((1 + monthly_interest_rate)**term - 1)
+
+def _npv_payments(payment, n_payments, discount_rate):
+    return payment * ((1 - (1 + discount_rate)**(-n_payments)) / discount_rate)
+
+def _npv_refi(payment_orig, term_orig, interest_rate_new, term_new, upb_new, discount_rate):
+    payment_new = _annuity(interest_rate_new, term_new, upb_new)
+    discount_to_refi = (1 + discount_rate)**(-(term_orig - term_new))
+    npv_orig = _npv_payments(payment_orig, term_orig - term_new, discount_rate)
+    npv_new = _npv_payments(payment_new, term_new, discount_rate) * discount_to_refi
+    npv_transaction_cost = (0.01 * upb_new + 2000) * discount_to_refi
+    return npv_orig + npv_new + npv_transaction_cost
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _annuity_kernel(interest_rate, term, principal, out):
+        for i in numba.prange(out.shape[0]):
+            growth = (1 + interest_rate[i])**term[i]
+            out[i] = principal[i] * (interest_rate[i] * growth) / (growth - 1)
+
+    @numba.njit(parallel=True, cache=True)
+    def _current_upb_kernel(loan_age, monthly_interest_rate, term, principal, out):
+        for i in numba.prange(out.shape[0]):
+            growth = (1 + monthly_interest_rate[i])**term[i]
+            out[i] = principal[i] * (growth - (1 + monthly_interest_rate[i])**loan_age[i]) / (growth - 1)
+
+    @numba.njit(parallel=True, cache=True)
+    def _npv_payments_kernel(payment, n_payments, discount_rate, out):
+        for i in numba.prange(out.shape[0]):
+            out[i] = payment[i] * ((1 - (1 + discount_rate[i])**(-n_payments[i])) / discount_rate[i])
+
+    @numba.njit(parallel=True, cache=True)
+    def _npv_refi_kernel(payment_orig, term_orig, interest_rate_new, term_new, upb_new, discount_rate, out):
+        for i in numba.prange(out.shape[0]):
+            d = discount_rate[i]
+            growth = (1 + interest_rate_new[i])**term_new[i]
+            payment_new = upb_new[i] * (interest_rate_new[i] * growth) / (growth - 1)
+            discount_to_refi = (1 + d)**(-(term_orig[i] - term_new[i]))
+            npv_orig = payment_orig[i] * ((1 - discount_to_refi) / d)
+            npv_new = payment_new * ((1 - (1 + d)**(-term_new[i])) / d) * discount_to_refi
+            npv_transaction_cost = (0.01 * upb_new[i] + 2000) * discount_to_refi
+            out[i] = npv_orig + npv_new + npv_transaction_cost
+else:
+    _annuity_kernel = _current_upb_kernel = _npv_payments_kernel = _npv_refi_kernel = None
@@ -0,0 +1,97 @@
+from functools import lru_cache
+import numpy as np
+from scipy.special import ndtr
+
+# market and contract rates in percent, and pre-tax transaction costs per dollar of balance
+RATE_GRID = np.round(np.arange(1.0, 13.0 + 0.0625, 0.125), 6)
+COST_GRID = np.geomspace(0.01, 0.5, 16)
+MAX_TERM = 360
+
+def build_rate_transition(rate_grid, monthly_vol):
+    """
+    Tauchen discretization of a driftless random walk in the market rate, with `monthly_vol` in
+    percentage points. Row i is the distribution of next month's rate given rate_grid[i]; the
+    tails are absorbed at the edges of the grid.
+    """
+    step = rate_grid[1] - rate_grid[0]
+    change = rate_grid[None, :] - rate_grid[:, None]
+    upper = ndtr((change + step / 2) / monthly_vol)
+    lower = ndtr((change - step / 2) / monthly_vol)
+    upper[:, -1] = 1
+    lower[:, 0] = 0
+    return upper - lower
+
+@lru_cache(maxsize=None)
+def solve_refi_thresholds(prob_move, annual_discount_rate, marginal_tax_rate, rate_vol, max_term=MAX_TERM):
+    """
+    Solve the refinancing problem by backward induction and return the optimal threshold, in
+    percentage points of rate gap, for every (remaining term, transaction cost, contract rate)
+    on the grids.
+
+    The value function is the present cost of the remaining obligations per dollar of balance,
+    V_n(c, r) for n payments left at contract rate c when the market rate is r. Each month the
+    borrower either keeps the loan, paying the annuity and carrying the amortized balance into
+    next month (repaid at par if they move, with monthly hazard `prob_move` / 12), or pays the
+    transaction cost and takes a new n-payment loan at r. As in the ADL rule, the cost is
+    grossed up by 1 / (1 - `marginal_tax_rate`). Results are cached by parameter tuple.
+    """
+    rate_grid, cost_grid = RATE_GRID, COST_GRID / (1 - marginal_tax_rate)
+    n_rates = len(rate_grid)
+    transition_t = build_rate_transition(rate_grid, 100 * rate_vol / np.sqrt(12)).T
+    discount = 1 / (1 + annual_discount_rate / 12)
+    monthly_move = prob_move / 12
+    monthly_rate = rate_grid / 1200
+    diagonal = np.arange(n_rates)
+
+    threshold = np.full((max_term + 1, len(cost_grid), n_rates), np.nan)
+    value = np.zeros((len(cost_grid), n_rates, n_rates))
+    for n in range(1, max_term + 1):
+        payment = monthly_rate / (1 - (1 + monthly_rate)**(-n))
+        balance = 1 + monthly_rate - payment
+        expected_value = value @ transition_t
+        hold = payment[None, :, None] + discount * balance[None, :, None] * (monthly_move + (1 - monthly_move) * expected_value)
+        refi = cost_grid[:, None, None] + hold[:, diagonal, diagonal][:, None, :]
+        threshold[n] = rate_grid[None, :] - find_refi_rate(hold - refi, rate_grid)
+        value = np.minimum(hold, refi)
+    return {'threshold': threshold, 'rate_grid': RATE_GRID, 'cost_grid': COST_GRID}
+
+def find_refi_rate(gain, rate_grid):
+    """
+    Highest market rate at which refinancing gains, interpolating linearly between the last grid
+    rate with a positive gain and the next one. NaN where refinancing never gains.
+    """
+    positive = gain > 0
+    n_rates = len(rate_grid)
+    last = n_rates - 1 - np.argmax(positive[..., ::-1], axis=-1)
+    following = np.minimum(last + 1, n_rates - 1)
+    gain_last = np.take_along_axis(gain, last[..., None], axis=-1)[..., 0]
+    gain_following = np.take_along_axis(gain, following[..., None], axis=-1)[..., 0]
+    has_following = following > last
+    weight = np.where(has_following, gain_last / np.where(has_following, gain_last - gain_following, 1), 0)
+    refi_rate = rate_grid[last] + weight * (rate_grid[following] - rate_grid[last])
+    return np.where(positive.any(axis=-1), refi_rate, np.nan)
+
+def interpolate_refi_threshold(solution, time_to_maturity, rate_orig, transaction_cost):
+    """
+    Look up the optimal threshold for each loan-month: exact in remaining term, bilinear in the
+    contract rate and the log transaction cost. Values outside the grids are clamped to the edges.
+    """
+    threshold = solution['threshold']
+    rate_grid, cost_grid = solution['rate_grid'], solution['cost_grid']
+    time_to_maturity = np.asarray(time_to_maturity, dtype=float)
+    n = np.clip(np.nan_to_num(time_to_maturity, nan=0), 0, threshold.shape[0] - 1).astype(int)
+
+    rate_position = np.interp(rate_orig, rate_grid, np.arange(len(rate_grid)))
+    cost_position = np.interp(np.log(transaction_cost), np.log(cost_grid), np.arange(len(cost_grid)))
+    rate_lower = np.minimum(np.floor(np.nan_to_num(rate_position)).astype(int), len(rate_grid) - 2)
+    cost_lower = np.minimum(np.floor(np.nan_to_num(cost_position)).astype(int), len(cost_grid) - 2)
+    rate_weight = rate_position - rate_lower
+    cost_weight = cost_position - cost_lower
+
+    interpolated = (
+        (1 - cost_weight) * (1 - rate_weight) * threshold[n, cost_lower, rate_lower]
+        + (1 - cost_weight) * rate_weight * threshold[n, cost_lower, rate_lower + 1]
+        + cost_weight * (1 - rate_weight) * threshold[n, cost_lower + 1, rate_lower]
+        + cost_weight * rate_weight * threshold[n, cost_lower + 1, rate_lower + 1]
+    )
+    return np.where(np.isnan(time_to_maturity), np.nan, interpolated)
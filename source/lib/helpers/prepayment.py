@@ -0,0 +1,14 @@
+import numpy as np
+
+def compute_prepayment_speed(cube, by):
+    """
+    Single monthly mortality (SMM) and its annualized conditional prepayment rate (CPR) by the
+    cube dimensions in `by`, summing loans at risk and prepaid over all other dimensions. Filter
+    `cube` first to condition on a parameter type, sample or any other dimension.
+    The cube is built from a sample of loans that all eventually prepay, so SMM and CPR are biased
+    upward: they are prepayment speeds conditional on prepaying at some point.
+    """
+    counts = cube.groupby(by, as_index=False, observed=True)[['n_at_risk', 'n_prepaid']].sum()
+    counts['smm'] = counts['n_prepaid'] / counts['n_at_risk'].replace(0, np.nan)
+    counts['cpr'] = 1 - (1 - counts['smm'])**12
+    return counts
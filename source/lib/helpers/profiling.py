@@ -0,0 +1,110 @@
+import io
+import time
+import pstats
+import cProfile
+import functools
+import tracemalloc
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+class StageProfiler:
+    """
+    Record the wall time, peak traced memory above the starting level and row counts of every call
+    to the wrapped stages, and optionally a cProfile of each outermost stage. Stages may call each
+    other; a nested stage's peak also counts towards the stages that called it.
+    """
+    def __init__(self, cprofile=False, n_functions=15):
+        self.cprofile = cprofile
+        self.n_functions = n_functions
+        self.records = []
+        self.profiles = {}
+        self._stack = []
+
+    def instrument(self, namespace, names):
+        """Replace each function in `names` in `namespace`, e.g. a module's globals(), with a profiled wrapper."""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        for name in names:
+            namespace[name] = self.wrap(namespace[name])
+
+    def wrap(self, stage):
+        @functools.wraps(stage)
+        def wrapper(*args, **kwargs):
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], tracemalloc.get_traced_memory()[1])
+            memory_start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            frame = {'stage': stage.__name__, 'peak': memory_start}
+            self._stack.append(frame)
+            profile = cProfile.Profile() if self.cprofile and len(self._stack) == 1 else None
+
+            time_start = time.perf_counter()
+            if profile is not None:
+                profile.enable()
+            try:
+                result = stage(*args, **kwargs)
+            finally:
+                if profile is not None:
+                    profile.disable()
+                wall_time = time.perf_counter() - time_start
+                self._stack.pop()
+                peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                if self._stack:
+                    self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+
+            self.records.append({
+                'stage': stage.__name__,
+                'parent': self._stack[-1]['stage'] if self._stack else '',
+                'wall_time': wall_time,
+                'peak_memory_mb': (peak - memory_start) / 2**20,
+                'rows_in': count_rows(args[0]) if args else np.nan,
+                'rows_out': count_rows(result)
+            })
+            if profile is not None:
+                self.profiles.setdefault(stage.__name__, []).append(profile)
+            return result
+        return wrapper
+
+    def summarize(self):
+        """One row per stage, ranked by total wall time."""
+        columns = ['stage', 'parent', 'wall_time', 'peak_memory_mb', 'rows_in', 'rows_out']
+        records = pd.DataFrame(self.records, columns=columns)
+        summary = records.groupby(['stage', 'parent'], sort=False).agg(
+            calls=('wall_time', 'size'),
+            wall_time=('wall_time', 'sum'),
+            peak_memory_mb=('peak_memory_mb', 'max'),
+            rows_in=('rows_in', 'max'),
+            rows_out=('rows_out', 'max')
+        ).reset_index().astype({'rows_in': 'Int64', 'rows_out': 'Int64'})
+        total = summary.loc[summary['parent'] == '', 'wall_time'].sum()
+        summary['share_wall_time'] = summary['wall_time'] / total if total > 0 else np.nan
+        return summary.sort_values('wall_time', ascending=False, ignore_index=True)
+
+    def write_report(self, report_file):
+        """Write the ranked stage summary and, with cProfile on, the slowest functions of each outermost stage."""
+        tracemalloc.stop()
+        report = io.StringIO()
+        report.write(f'Stage profile written {time.strftime("%Y-%m-%d %H:%M:%S")}\n')
+        report.write('wall_time in seconds; peak_memory_mb is the peak traced memory above the level at stage start\n\n')
+        report.write(self.summarize().to_string(index=False, float_format=lambda x: f'{x:.3f}'))
+        report.write('\n')
+        for stage, profiles in self.profiles.items():
+            report.write(f'\n==== cProfile: {stage} ====\n')
+            stats = pstats.Stats(*profiles, stream=report)
+            stats.sort_stats('cumulative').print_stats(self.n_functions)
+
+        report_file = Path(report_file)
+        report_file.parent.mkdir(parents=True, exist_ok=True)
+        report_file.write_text(report.getvalue())
+        print(f"Profile '{report_file}' saved successfully.")
+
+def count_rows(value):
+    """Rows of a DataFrame or array, of the first array in a dict of columns, or of the first item of a tuple."""
+    if isinstance(value, tuple):
+        return count_rows(value[0]) if value else np.nan
+    if isinstance(value, dict):
+        return count_rows(next(iter(value.values()))) if value else np.nan
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return len(value)
+    return np.nan
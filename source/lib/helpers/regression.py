@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+
+def build_design_matrix(df, covariates, fixed_effects=None, intercept=True):
+    """
+    Regressor matrix with an intercept, `covariates` as numbers and one dummy per level of each
+    fixed effect after the first. `fixed_effects` maps a column to its full list of levels, which
+    must be the same in every partition so that the columns line up; values outside the levels get
+    no dummy. Rows with a missing covariate are NaN.
+    """
+    fixed_effects = fixed_effects or {}
+    columns = []
+    if intercept:
+        columns.append(np.ones((len(df), 1)))
+    if covariates:
+        columns.append(np.column_stack([pd.to_numeric(df[column], errors='coerce').to_numpy(dtype=float) for column in covariates]))
+    for column, levels in fixed_effects.items():
+        codes = pd.Categorical(df[column], categories=levels).codes
+        dummies = np.zeros((len(df), max(len(levels) - 1, 0)))
+        has_dummy = codes >= 1
+        dummies[np.flatnonzero(has_dummy), codes[has_dummy] - 1] = 1
+        columns.append(dummies)
+    return np.hstack(columns) if columns else np.empty((len(df), 0))
+
+def accumulate_normal_equations(X, y):
+    """X'X, X'y and the row count over the complete rows of one partition. They add across partitions."""
+    keep = ~(np.isnan(X).any(axis=1) | np.isnan(y))
+    X, y = X[keep], y[keep]
+    return {'xtx': X.T @ X, 'xty': X.T @ y, 'n': int(keep.sum())}
+
+def combine_normal_equations(parts):
+    """Sum `accumulate_normal_equations` output over partitions."""
+    parts = list(parts)
+    return {key: sum(part[key] for part in parts) for key in ['xtx', 'xty', 'n']}
+
+def solve_normal_equations(normal_equations):
+    """Least-squares coefficients. Collinear columns, such as levels never observed, get the minimum-norm solution."""
+    return np.linalg.lstsq(normal_equations['xtx'], normal_equations['xty'], rcond=None)[0]
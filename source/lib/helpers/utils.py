@@ -1,4 +1,7 @@
+import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from datetime import datetime
 
 def get_quarters(start_date, end_date):
@@ -8,6 +11,78 @@ def get_quarters(start_date, end_date):
     periods = pd.period_range(start=start_date, end=end_date, freq='Q')
     return [f"{p.year}Q{p.quarter}" for p in periods]
 
+def count_row_groups(path, filters):
+    """
+    Row groups of a parquet dataset in total and those a read with `filters` (in the format of
+    `read_parquet`) has to decode, i.e. whose min/max statistics do not rule them out.
+    """
+    expression = pq.filters_to_expression(filters)
+    fragments = list(ds.dataset(path, format='parquet').get_fragments())
+    n_total = sum(fragment.num_row_groups for fragment in fragments)
+    n_read = sum(len(fragment.split_by_row_group(filter=expression)) for fragment in fragments)
+    return n_total, n_read
+
+def get_block_starts(keys):
+    """
+    Flag the first row of each block of contiguous equal keys.
+    Rows of a group must be contiguous, e.g. a frame sorted by loan_id.
+    """
+    keys = np.asarray(keys)
+    starts = np.ones(len(keys), dtype=bool)
+    starts[1:] = keys[1:] != keys[:-1]
+    return starts
+
+def get_block_position(keys):
+    """
+    Position of each row within its block of contiguous equal keys.
+    Equivalent to groupby(keys).cumcount() when rows of a group are contiguous.
+    """
+    starts = get_block_starts(keys)
+    index = np.arange(len(starts))
+    return index - np.maximum.accumulate(np.where(starts, index, 0))
+
+def get_block_index(keys):
+    """
+    Index of the block of contiguous equal keys that each row belongs to.
+    Use it to broadcast one value per block back to rows: `values[get_block_index(keys)]`.
+    """
+    return np.cumsum(get_block_starts(keys)) - 1
+
+def get_first_in_block(mask, keys):
+    """
+    Row position of the first True in each block of contiguous equal keys, or -1 if none.
+    `mask` may be 2D (rows by columns), in which case the result has one column per mask column.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    starts = np.flatnonzero(get_block_starts(keys))
+    if len(starts) == 0:
+        return np.empty((0,) + mask.shape[1:], dtype=int)
+    n_rows = mask.shape[0]
+    row_index = np.arange(n_rows).reshape((-1,) + (1,) * (mask.ndim - 1))
+    first = np.minimum.reduceat(np.where(mask, row_index, n_rows), starts, axis=0)
+    return np.where(first == n_rows, -1, first)
+
+def get_run_length(mask, keys):
+    """
+    Length of the run of consecutive True values ending at each row, restarting at each block
+    of contiguous equal keys. Rows where `mask` is False are 0. `mask` may be 2D (rows by columns).
+    """
+    mask = np.asarray(mask, dtype=bool)
+    shape = (-1,) + (1,) * (mask.ndim - 1)
+    starts = get_block_starts(keys).reshape(shape)
+    index = np.arange(len(mask)).reshape(shape)
+    last_break = np.maximum.accumulate(np.where(~mask, index, np.where(starts, index - 1, -1)), axis=0)
+    return index - last_break
+
+def get_block_cummax(values, keys):
+    """
+    Running maximum of non-negative integer `values` within each block of contiguous equal keys.
+    `values` may be 2D (rows by columns).
+    """
+    values = np.asarray(values)
+    offset = get_block_index(keys).reshape((-1,) + (1,) * (values.ndim - 1)) * (values.max(initial=0) + 1)
+    return np.maximum.accumulate(values + offset, axis=0) - offset
+
 def relocate(df, columns, before=None, after=None):
     """
     Relocate columns in a DataFrame before or after a reference column.
@@ -5,6 +5,7 @@ import hashlib
 import re
 import pathlib
 import pyarrow
+import dask
 import dask.dataframe as dd
 
 pd.set_option('display.float_format', lambda x: '%.3f' % x)
@@ -69,6 +70,9 @@ def get_summary_stats(df):
 
     var_stats = df.describe(include='all', percentiles = [.5]).transpose().infer_objects(copy=False)
     var_stats['count'] = df.notnull().sum()
+    return format_summary_stats(var_types, var_stats)
+
+def format_summary_stats(var_types, var_stats):
     var_stats = var_stats.drop(columns=['top', 'freq'], errors='ignore')
 
     summary_stats = pd.DataFrame({'type': var_types}).\
@@ -82,6 +86,84 @@ def get_summary_stats(df):
 
     return summary_stats
 
+def save_data_dask(ddf, keys, out_file, log_file = '', append = False, sortbykey = True, verbose = True):
+    """
+    Save a dask DataFrame to partitioned parquet from the workers, without collecting it.
+    Part files are zero-padded so that readers listing them lexically keep the sort order.
+    The MD5 hash in the log is the hash of the ordered per-partition hashes, and the
+    summary stats are reduced across partitions (the median is approximate). Only numeric
+    columns are described, since distinct counts of high-cardinality columns would be
+    collected into a single partition. With `sortbykey=False` the rows must already be
+    sorted by `keys`.
+    """
+    extension = check_extension(out_file)
+    if extension != '.parquet':
+        raise ValueError("Dask DataFrames can only be saved as .parquet.")
+
+    cols_reordered = keys + [col for col in ddf.columns if col not in keys]
+    ddf = ddf[cols_reordered]
+    if sortbykey:
+        ddf = ddf.sort_values(keys)
+    check_keys_dask(ddf, keys)
+
+    write = ddf.to_parquet(out_file, engine = "pyarrow", compression = "snappy", write_index = False, overwrite = True, compute = False,
+                           name_function = lambda i: f'part.{i:05d}.parquet')
+    partition_hashes = ddf.map_partitions(hash_partition, meta = (None, 'object'))
+    numeric_columns = list(ddf.select_dtypes('number').columns)
+    var_stats = ddf[numeric_columns].describe(percentiles = [.5]) if numeric_columns else pd.DataFrame()
+    var_counts = ddf.notnull().sum()
+    _, partition_hashes, var_stats, var_counts = dask.compute(write, partition_hashes, var_stats, var_counts)
+
+    df_hash = hashlib.md5(''.join(partition_hashes).encode()).hexdigest()
+    var_stats = var_stats.transpose().reindex(ddf.columns).infer_objects(copy=False)
+    var_stats['count'] = var_counts
+    summary_stats = format_summary_stats(ddf.dtypes, var_stats)
+    save_log(df_hash, keys, summary_stats, out_file, append, log_file)
+
+    if verbose:
+        print(f"File '{out_file}' saved successfully.")
+
+def check_keys_dask(ddf, keys):
+    """
+    Check keys as `check_keys` does, partition by partition. `ddf` must be sorted by `keys`, so
+    duplicates can only sit within a partition or across the boundary of adjacent partitions,
+    and only the first and last keys of each partition are collected.
+    """
+    if not isinstance(keys, list):
+        raise TypeError("Keys must be specified as a list.")
+
+    for key in keys:
+        if not key in ddf.columns:
+            print('%s is not a column name.' % (key))
+            raise ValueError('One of the keys you specified is not among the columns.')
+
+    partition_keys = ddf[keys].map_partitions(summarize_partition_keys, keys, meta = {
+        'keys_missing': object, 'has_duplicates': bool, 'first_key': object, 'last_key': object
+    }).compute()
+
+    keys_missing = pd.DataFrame(partition_keys['keys_missing'].tolist(), columns = keys).any()
+    keys_with_missing = keys_missing.index[keys_missing]
+    if keys_with_missing.any():
+        missings_string = ', '.join(keys_with_missing)
+        raise ValueError(f'The following keys are missing in some rows: {missings_string}.')
+
+    boundaries = partition_keys.dropna(subset = ['first_key'])
+    crosses_boundary = (boundaries['first_key'].iloc[1:].to_numpy() == boundaries['last_key'].iloc[:-1].to_numpy()).any()
+    if partition_keys['has_duplicates'].any() or crosses_boundary:
+        raise ValueError("Keys do not uniquely identify the observations.")
+
+def summarize_partition_keys(df, keys):
+    """Missing keys, whether any key repeats, and the first and last key of one partition."""
+    return pd.DataFrame({
+        'keys_missing': [df.isnull().any().tolist()],
+        'has_duplicates': [df.duplicated(keys).any()],
+        'first_key': [tuple(df.iloc[0]) if len(df) else None],
+        'last_key': [tuple(df.iloc[-1]) if len(df) else None]
+    })
+
+def hash_partition(df):
+    return pd.Series([hashlib.md5(pd.util.hash_pandas_object(df, index = False).values).hexdigest()])
+
 def save_df(df, keys, out_file, sortbykey, extension, verbose, n_partitions):
     if sortbykey:
         df.sort_values(keys, inplace = True)
@@ -0,0 +1,37 @@
+import json
+import time
+from dask.distributed import LocalCluster
+
+from source.lib.helpers.cluster import get_cluster_config
+
+# the fixed port the README exports as CLUSTER_SCHEDULER_ADDRESS
+SCHEDULER_PORT = 8786
+
+def main():
+    """
+    Start a long-lived LocalCluster sized from config.json and keep it running.
+    Export the printed address as CLUSTER_SCHEDULER_ADDRESS so that pipeline
+    stages attach to this cluster instead of starting their own.
+    """
+    with open('source/lib/config.json', 'r') as f:
+        CONFIG = json.load(f)
+    CLUSTER_CONFIG = get_cluster_config(CONFIG)
+
+    cluster = LocalCluster(
+        n_workers=CLUSTER_CONFIG['N_WORKERS'],
+        threads_per_worker=CLUSTER_CONFIG['THREADS_PER_WORKER'],
+        memory_limit=CLUSTER_CONFIG['MEMORY_LIMIT'],
+        scheduler_port=SCHEDULER_PORT
+    )
+    print(f"Scheduler running at {cluster.scheduler_address}")
+    print(f"export CLUSTER_SCHEDULER_ADDRESS={cluster.scheduler_address}")
+    print(f"Dashboard at {cluster.dashboard_link}")
+
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        cluster.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# scripts import the project as `source.…`, relative to the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
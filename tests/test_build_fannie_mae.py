@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+
+from source.derived.fannie_mae.build_fannie_mae import write_quarter
+from source.derived.fannie_mae.draw_sample import SAMPLE_FILTERS
+from source.lib.helpers.utils import count_row_groups
+
+def make_quarter(n_loans=400, n_periods=24, seed=0):
+    rng = np.random.default_rng(seed)
+    loans = pd.DataFrame({
+        'loan_id': [f'{i:012d}' for i in range(n_loans)],
+        'mortgage_type': rng.choice(['fixed', 'adjustable'], size=n_loans),
+        'term': rng.choice([180.0, 360.0], size=n_loans),
+        'upb_orig': rng.integers(100, 500, size=n_loans) * 1000.0
+    })
+    return loans.loc[loans.index.repeat(n_periods)].assign(period=np.tile(np.arange(1, n_periods + 1), n_loans)).reset_index(drop=True)
+
+def test_filtered_read_skips_row_groups(tmp_path):
+    df = make_quarter()
+    write_quarter(df.sample(frac=1, random_state=1), '2020Q1', 8, tmp_path, tmp_path)
+
+    n_total, n_read = count_row_groups(tmp_path / '2020Q1.parquet', SAMPLE_FILTERS)
+    assert n_read < n_total
+
+    df_read = pd.read_parquet(tmp_path / '2020Q1.parquet', filters=SAMPLE_FILTERS)
+    expected = df[(df['mortgage_type'] == 'fixed') & (df['term'] == 360)]
+    assert len(df_read) == len(expected)
+    assert df_read.groupby('loan_id')['period'].apply(lambda x: x.is_monotonic_increasing).all()
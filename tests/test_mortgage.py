@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+from source.lib.helpers import mortgage
+
+pytest.importorskip('numba')
+
+def make_inputs(n_random=200, seed=0):
+    """Random loans, then rows with a NaN input, a zero rate or a zero term."""
+    rng = np.random.default_rng(seed)
+    random = {
+        'payment': rng.uniform(300, 3000, n_random),
+        'loan_age': rng.integers(0, 361, n_random).astype(float),
+        'rate': rng.uniform(0.001, 0.01, n_random),
+        'term': rng.integers(1, 361, n_random).astype(float),
+        'principal': rng.uniform(5e4, 5e5, n_random),
+        'discount_rate': rng.uniform(0.001, 0.01, n_random)
+    }
+    edge = {
+        'payment': [np.nan, 500, 500, 500, 500],
+        'loan_age': [12, np.nan, 12, 0, 12],
+        'rate': [0.003, 0.003, 0, 0.003, 0.003],
+        'term': [360, 360, 360, 0, 360],
+        'principal': [1e5, 1e5, 1e5, 1e5, np.nan],
+        'discount_rate': [0.004, 0.004, 0.004, 0.004, 0]
+    }
+    return {name: np.concatenate([random[name], np.asarray(edge[name], dtype=float)]) for name in random}
+
+CALLS = {
+    'annuity': lambda x: mortgage.annuity(x['rate'], x['term'], x['principal']),
+    'current_upb': lambda x: mortgage.current_upb(x['loan_age'], x['rate'], x['term'], x['principal']),
+    'npv_payments': lambda x: mortgage.npv_payments(x['payment'], x['term'], x['discount_rate']),
+    'npv_refi': lambda x: mortgage.npv_refi(x['payment'], x['term'] + 60, x['rate'], x['term'], x['principal'], x['discount_rate'])
+}
+
+@pytest.mark.parametrize('name', list(CALLS))
+def test_numba_matches_numpy(name, monkeypatch):
+    inputs = make_inputs()
+    monkeypatch.setattr(mortgage, 'USE_NUMBA', True)
+    compiled = CALLS[name](inputs)
+    monkeypatch.setattr(mortgage, 'USE_NUMBA', False)
+    reference = CALLS[name](inputs)
+    np.testing.assert_allclose(compiled, reference, rtol=1e-10, equal_nan=True)
+
+@pytest.mark.parametrize('use_numba', [True, False])
+def test_scalar_zero_term_refi_is_nan(use_numba, monkeypatch):
+    monkeypatch.setattr(mortgage, 'USE_NUMBA', use_numba)
+    assert np.isnan(mortgage.npv_refi(500., 360., 0.003, 0., 1e5, 0.004))
@@ -0,0 +1,73 @@
+import os
+import json
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parents[1]
+
+def make_sample(n_loans=40, seed=0):
+    """Fixed-rate 30-year loans originated 2015-2017 and observed to 2025, about half of them prepaid."""
+    rng = np.random.default_rng(seed)
+    loans = []
+    for i in range(n_loans):
+        period_orig = int(rng.integers(181, 215))
+        rate_orig = round(float(rng.uniform(3.5, 5)), 3)
+        upb_orig = float(rng.integers(100, 500) * 1000)
+        period_exit = float(rng.integers(period_orig + 12, 307)) if rng.random() < 0.5 else np.nan
+        period = np.arange(period_orig + 1, 307 if np.isnan(period_exit) else int(period_exit) + 1)
+        monthly_rate = rate_orig / 1200
+        upb_curr = upb_orig * ((1 + monthly_rate)**360 - (1 + monthly_rate)**(period - period_orig)) / ((1 + monthly_rate)**360 - 1)
+        if not np.isnan(period_exit):
+            upb_curr[-1] = 0
+        loans.append(pd.DataFrame({
+            'loan_id': f'{i:012d}', 'period': period, 'rate_orig': rate_orig, 'upb_orig': upb_orig,
+            'upb_curr': upb_curr.round(2), 'ltv': 80.0, 'dti': 35.0, 'n_borrowers': '1', 'term': 360.0,
+            'period_orig': period_orig, 'period_first_pay': period_orig + 2, 'time_from_orig': (period - period_orig).astype(float),
+            'time_to_maturity': (period_orig + 360 - period).astype(float), 'period_maturity': float(period_orig + 360),
+            'time_to_exit': period_exit - period, 'period_exit': period_exit,
+            'exit_code': None if np.isnan(period_exit) else 'prepaid', 'upb_last': np.nan, 'credit_score_orig': 740.0,
+            'coborrower_credit_score_orig': np.nan, 'first_home_buyer': 0.0, 'mortgage_type': 'fixed', 'purpose': 'P',
+            'dlq_status': 0, 'state': 'Ohio', 'state_abbr': 'oh', 'fips_state': 39.0, 'msa': '0', 'zip': '430'
+        }))
+    return pd.concat(loans, ignore_index=True)
+
+def make_workspace(path):
+    """The inputs of process_fannie_mae.py, laid out under `path` as under the repository root."""
+    config = json.loads((ROOT / 'source/lib/config.json').read_text())
+    config['STAGE_CACHE'] = False
+    config['CLUSTER']['N_WORKERS'] = 2
+    sweep = {
+        'GRID': {
+            'ANNUAL_DISCOUNT_RATE': {'START': 0.02, 'STOP': 0.05, 'NUM': 2},
+            'PROB_MOVE': {'START': 0.05, 'STOP': 0.1, 'NUM': 2},
+            'MARGINAL_TAX_RATE': {'START': 0.0, 'STOP': 0.28, 'NUM': 2}
+        },
+        'CHUNK_SIZE': 4
+    }
+    (path / 'source/lib').mkdir(parents=True)
+    (path / 'source/lib/config.json').write_text(json.dumps(config))
+    (path / 'source/lib/sweep.json').write_text(json.dumps(sweep))
+    shutil.copy(ROOT / 'source/lib/parameters.json', path / 'source/lib/parameters.json')
+    shutil.copytree(ROOT / 'output/derived/fred', path / 'output/derived/fred')
+
+    (path / 'datastore/raw/crosswalks/data').mkdir(parents=True)
+    dates = pd.date_range('2000-01-01', '2056-01-01', freq='MS')
+    pd.DataFrame({'date': dates, 'period': np.arange(1, len(dates) + 1)}).to_csv(path / 'datastore/raw/crosswalks/data/cw_period_date.csv', index=False)
+    (path / 'datastore/output/derived/fannie_mae').mkdir(parents=True)
+    make_sample().to_parquet(path / 'datastore/output/derived/fannie_mae/sflp_sample.parquet', index=False)
+
+def test_sweep_runs_end_to_end(tmp_path):
+    make_workspace(tmp_path)
+    # a worker pool forked after the numba kernels have run would hang at shutdown
+    subprocess.run(
+        [sys.executable, str(ROOT / 'source/derived/fannie_mae/process_fannie_mae.py'), '--sweep'],
+        cwd=tmp_path, env={**os.environ, 'PYTHONPATH': str(ROOT)}, check=True, timeout=600
+    )
+
+    df_sweep = pd.read_parquet(tmp_path / 'datastore/output/derived/fannie_mae/sflp_sample_sweep.parquet')
+    assert len(df_sweep) == 2 * 2 * 2 * 2
+    assert (df_sweep.loc[df_sweep['sample'] == 'full', 'n_loans'] > 0).all()